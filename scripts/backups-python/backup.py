@@ -4,13 +4,17 @@
 """Tool for creating borg backups
 
 Usage:
+  backup.py status [--json] CONFIG...
+  backup.py compression [--critical] [--error] [--warning] [--info] [--debug]
+            [--samples N] [--min-speed MBS] CONFIG...
   backup.py [--critical] [--error] [--warning] [--info] [--debug] [--no-create]
-            [--no-prune] [--no-schedule] [--comment COMMENT] CONFIG
+            [--no-prune] [--no-maintenance] [--no-schedule] [--jobs N] [--pipeline] [--refresh-paths]
+            [--comment COMMENT] CONFIG...
   backup.py (-h|--help)
   backup.py --version
 
 Arguments:
-  CONFIG               path to the backup config file
+  CONFIG               path to a backup config file or a directory of config files
 
 General Options:
   -h --help            show this message and exit
@@ -22,61 +26,137 @@ General Options:
   --debug              work on log level DEBUG
   --no-create          don't create a backup archive
   --no-prune           don't prune the repository
+  --no-maintenance     don't compact or check the repository
   --no-schedule        don't schedule a rerun if the ssh host can't be reached
+  -j N --jobs N        back up at most N repositories concurrently [default: 4]
+  --pipeline           start creating the next archive while the previous
+                       repository is still being pruned, only with --jobs 1
+  --refresh-paths      expand the backup paths again, even if they are cached
   --comment COMMENT    add a comment text to the archive
 
+Status Options:
+  --json               print the status as json
+
+Compression Options:
+  --samples N          number of files sampled below each backup path [default: 32]
+  --min-speed MBS      compression speed per core in MB/s, that the recommended
+                       setting must reach [default: 100]
+
+Repositories sharing an ssh host or a mount point are always backed up one
+after another. With --jobs 1 and --pipeline, the prune of one repository
+overlaps with the creation of the next archive instead, --pipeline is ignored
+with more jobs. Each config needs its own logging name (or lock file) and borg
+log.
+
+The status command answers from the borg info and list output, that is saved
+after every backup, without accessing the repository.
+
+The compression command benchmarks the compressors borg supports on samples
+of the backup paths and records a recommendation, which is used if the backup
+compression is set to tuned.
+
 Log levels refer to what is printed to stdout, lowest specified log
 level takes precedence (i.e. DEBUG < INFO < ... < CRITICAL).
 """
 
-# TODO: Launch backup scripts with nice
 # TODO: backup.py [server/create/...]???
 # TODO: improve format for delay config option
 
+import contextlib
+import functools
 import logging
 import os
 import shlex
-import subprocess as sp
+import signal
 import sys
+import threading
 import time
 from datetime import datetime as dt
-from datetime import timedelta as delta
-from logging import makeLogRecord
-from logging.handlers import RotatingFileHandler
 from os.path import basename
 
 from docopt import docopt
-from tendo import singleton
 
-import utils
-from config import Config, init_logging
-from utils import append_tb, appendix
+from lazy import lazy_import
+
+cfg = lazy_import('config')
+borg_stats = lazy_import('stats')
+changes = lazy_import('changes')
+dataclasses = lazy_import('dataclasses')
+futures = lazy_import('concurrent.futures')
+json = lazy_import('json')
+logsink = lazy_import('logsink')
+metrics = lazy_import('metrics')
+snapshots = lazy_import('snapshots')
+sp = lazy_import('subprocess')
+tuning = lazy_import('compression_tuning')
+utils = lazy_import('utils')
 
 logger = logging.getLogger(__name__)
 slack = logging.getLogger("slack")
+started = time.monotonic()
+
+CHECKPOINT_SUFFIX = ".checkpoint"
 
 
-def prepare_backup(config, arguments) -> singleton.SingleInstance:
+def prepare_backup(config, arguments, run) -> tuple:
     if (lock := utils.ensure_single_instance(config.lock_file)) is None:
         raise utils.SingleInstanceError()
 
-    if not all(map(utils.ensure_mounted, config.ensure_mounted)):
-        raise utils.MountPointError()
+    def mount_chain(chain):
+        # Nested mount points are mounted one after another, parents first, so no child gets hidden
+        return all(run.timed('ensure_mounted', utils.ensure_mounted, target=m)(
+            m, config.mount_timeout, config.mount_command) for m in chain)
+
+    checks = {f"mount {', '.join(c)}": (utils.MountPointError, functools.partial(mount_chain, c))
+              for c in utils.mount_chains(config.ensure_mounted)}
+
+    if config.use_ssh:
+        checks[f"ssh {config.ssh_host}"] = (utils.ConnectionError, functools.partial(
+            run.timed('test_connection', utils.test_connection, target=config.ssh_host),
+            config.ssh_user, config.ssh_host, config.ssh_port, config.ssh_key_file,
+            config.ssh_control_path, config.ssh_control_persist))
 
-    if config.use_ssh and not utils.test_connection(
-        config.ssh_user, config.ssh_host, config.ssh_port, config.ssh_key_file):
-        raise utils.ConnectionError()
+    if failures := utils.run_checks({k: v[1] for k, v in checks.items()}, config.check_timeout):
+        report = "\n".join(f"{name}: {reason}" for name, reason in failures.items())
+        logger.error(utils.appendix(f"{len(failures)} of {len(checks)} pre-flight checks failed", report))
+
+        # Mount point errors take precedence, the backup is only rescheduled if just ssh failed
+        errors = [checks[name][0] for name in failures]
+        error = utils.MountPointError if utils.MountPointError in errors else utils.ConnectionError
+        raise error(report)
 
     if config.ask_repo_passphrase:
-        config.set(utils.ask_passphrase(basename(config.repo_path)), 'backup', 'repository', 'passphrase')
+        config = dataclasses.replace(config, repo_passphrase=utils.ask_passphrase(basename(config.repo_path)))
 
-    return lock
+    return lock, config
 
 
-def create_backup(config, command_gen, environment) -> int:
+def create_backup(config, command_gen, environment, run) -> int:
     logger.info(f"Creating backup archive, borg_log='{config.borg_log}'")
 
-    if (exit_code := run_borg_command(command_gen.create(), config.borg_log, environment)) == 0:
+    stats = borg_stats.BorgStats('create')
+    interrupted = os.path.exists(config.interrupted_file)
+
+    with run.phase('create_backup', restarts=0) as record:
+        while True:
+            rate, remaining = utils.current_ratelimit(config.remote_ratelimit)
+            logger.debug(f"Using a ratelimit of {rate} kiB/s, changes in {remaining} seconds")
+
+            # The checkpoints are only looked up if the last borg create didn't finish
+            archive = resumable_archive(config, command_gen, environment) if interrupted else None
+            record_interruption(config, True)
+            command = command_gen.create(rate, archive)
+            if (exit_code := run_borg_command(command, config, environment, stats, remaining)) is not None:
+                break
+
+            # Files that were already transferred are deduplicated against the checkpoint
+            logger.info("Restarting borg from its checkpoint, the ratelimit has changed")
+            record['restarts'] += 1
+            interrupted = True
+
+        record.update(stats.totals())
+
+    if exit_code == 0:
         logger.debug("Successfully created the backup archive")
     elif exit_code == 1:
         logger.warning("Borg produced a warning while creating the archive, exit_code=1")
@@ -86,12 +166,71 @@ def create_backup(config, command_gen, environment) -> int:
         logger.error(f"Borg produced an error while creating the archive, exit_code={exit_code}")
         slack.error("Backup procedure failed: An error occurred while creating the archive")
 
+    if exit_code <= 1:
+        record_interruption(config, False)
+
+    if config.borg_progress:
+        stats.save(config.stats_file)
     return exit_code
 
-def prune_repository(config, command_gen, environment) -> int:
+
+def checkpoints(config, command_gen, environment) -> list:
+    # Returns the checkpoint archives of the prefix from oldest to newest, and the other archive names
+    if (listing := query_borg(command_gen.list_archives(), config, environment)) is None:
+        return [], set()
+
+    archives = sorted(listing.get('archives', []), key=lambda a: a.get('time', ""))
+    names = [a['name'] for a in archives if CHECKPOINT_SUFFIX in a['name']]
+    return names, {a['name'] for a in archives} - set(names)
+
+
+def resumable_archive(config, command_gen, environment):
+    # borg names checkpoints <archive>.checkpoint or <archive>.checkpoint.N
+    if not config.resume_checkpoints:
+        return None
+
+    names, archives = checkpoints(config, command_gen, environment)
+    for name in reversed(names):
+        if (archive := name.rsplit(CHECKPOINT_SUFFIX, 1)[0]) not in archives:
+            logger.info(f"Resuming the backup from the checkpoint archive '{name}'")
+            return archive
+    return None
+
+
+def delete_checkpoints(config, command_gen, environment):
+    # borg prune removes superseded checkpoints, this only runs if the repository isn't pruned
+    names, _ = checkpoints(config, command_gen, environment)
+    logger.debug(f"Deleting {len(names)} superseded checkpoint archives")
+
+    for name in names:
+        if (exit_code := run_borg_command(command_gen.delete(name), config, environment)) > 1:
+            logger.warning(f"Unable to delete the checkpoint archive '{name}', exit_code={exit_code}")
+
+
+def record_interruption(config, interrupted):
+    # The marker is removed once borg create finished, so it is left behind by killed or failed runs
+    if not config.resume_checkpoints:
+        return
+
+    try:
+        if interrupted:
+            open(config.interrupted_file, 'w').close()
+        elif os.path.exists(config.interrupted_file):
+            os.remove(config.interrupted_file)
+    except OSError as e:
+        logger.warning(f"Unable to record the state of borg create, interrupted_file='{config.interrupted_file}': {e}")
+
+
+def prune_repository(config, command_gen, environment, run) -> int:
     logger.info(f"Pruning the repository, borg_log='{config.borg_log}'")
 
-    if (exit_code := run_borg_command(command_gen.prune(), config.borg_log, environment)) == 0:
+    stats = borg_stats.BorgStats('prune')
+
+    with run.phase('prune_repository') as record:
+        exit_code = run_borg_command(command_gen.prune(), config, environment, stats)
+        record.update(stats.totals())
+
+    if exit_code == 0:
         logger.debug("Successfully pruned the repository")
     elif exit_code == 1:
         logger.warning("Borg produced a warning, while pruning the repository, exit_code=1")
@@ -100,69 +239,431 @@ def prune_repository(config, command_gen, environment) -> int:
         logger.error(f"Borg produced an error while pruning the repository, exit_code={exit_code}")
         slack.error("Backup procedure failed: An error occurred while pruning the repository")
 
+    if config.borg_progress:
+        stats.save(config.stats_file)
     return exit_code
 
-def run_borg_command(command, log_file, env) -> int:
+def run_borg_command(command, config, env, stats=None, timeout=None) -> int:
+    # Returns None if borg was interrupted after the timeout, borg writes a checkpoint on SIGINT
+    logger.debug(f"Running borg {time.monotonic() - started:.3f}s after startup")
     logger.debug(command)
+    expired = threading.Event()
+
+    def interrupt():
+        expired.set()
+        proc.send_signal(signal.SIGINT)
+
+    with logsink.RotatingLog(config.borg_log, config.borg_log_size, config.borg_log_count,
+                             config.borg_log_compression) as log:
+        with sp.Popen(shlex.split(command), bufsize=logsink.PIPE_SIZE, stdout=sp.PIPE,
+                      stderr=sp.STDOUT, env=env, cwd=config.work_dir) as proc:
+            logsink.widen_pipe(proc.stdout)
+
+            if timeout is not None:
+                timer = threading.Timer(timeout, interrupt)
+                timer.daemon = True
+                timer.start()
+
+            if stats is None:
+                while chunk := proc.stdout.read1(logsink.PIPE_SIZE):
+                    log.write(chunk)
+            else:
+                for line in proc.stdout:
+                    if (data := stats.feed(line)) is not None:
+                        log.write(data)
 
-    with open(log_file, 'ab') as f:
-        try:
-            exit_code = sp.check_call(shlex.split(command), bufsize=-1, stdout=f, stderr=f, env=env)
-        except sp.CalledProcessError as e:
-            exit_code = e.returncode
-        finally:
-            f.write(b"\n")
+        log.write(b"\n")
 
-    RotatingFileHandler(log_file, mode='a', maxBytes=1048576, backupCount=1).emit(makeLogRecord({}))
-    return exit_code
+    if timeout is not None:
+        timer.cancel()
+        if expired.is_set() and proc.returncode != 0:
+            logger.debug(f"Interrupted borg after {timeout} seconds, exit_code={proc.returncode}")
+            return None
+
+    if stats is not None:
+        stats.finish(proc.returncode)
+    return proc.returncode
+
+
+def query_borg(command, config, env):
+    # Returns the json output of borg, its log messages are written to the borg log
+    logger.debug(command)
+
+    with logsink.RotatingLog(config.borg_log, config.borg_log_size, config.borg_log_count,
+                             config.borg_log_compression) as log:
+        proc = sp.run(shlex.split(command), stdout=sp.PIPE, stderr=sp.PIPE, env=env)
+        log.write(proc.stderr)
 
+    try:
+        if proc.returncode <= 1:
+            return json.loads(proc.stdout)
+    except ValueError:
+        pass
 
-def main(config, arguments):
+    logger.warning(f"Unable to query the repository, exit_code={proc.returncode}")
+    return None
+
+
+def main(config, arguments, run, pipeline=None):
     logger.info("Prepearing backup procedure")
 
-    lock = prepare_backup(config, arguments)
+    with run.phase('prepare_backup'):
+        lock, config = prepare_backup(config, arguments, run)
 
     logger.info("Performing backup procedure")
     command_gen = utils.CommandGenerator(config, arguments)
     env = utils.EnvironmentGenerator(config).get_env()
-    logger.debug(appendix(f"Borg environment variables are:", env))
+    logger.debug(utils.appendix(f"Borg environment variables are:", env))
 
     backup_exit = 0
 
     if arguments['--no-create']:
         logger.info("No backup archive will be created, --no-create option is set")
-    elif (backup_exit := create_backup(config, command_gen, env)) > 1:
+    elif (backup_exit := run_hooks('pre-create', config.pre_create_hooks, config, run)) > 1:
         raise utils.BorgCommandError(exit_code=backup_exit)
+    else:
+        # The changes are scanned after the pre-create hooks, so the dumps they write are compared as well
+        if (manifest := scan_changes(config, run) if config.skip_unchanged else {}) is None:
+            logger.info("Nothing changed below the backup paths, no backup archive will be created")
+            create_exit = 0
+        else:
+            with snapshots.SnapshotSet(config.snapshot_type, config.snapshot_dir, config.log_name,
+                                       config.snapshot_lvm_size) as snapshot_set:
+                with run.phase('take_snapshots'):
+                    work_dir, paths = snapshot_set.take(config.backup_paths)
+
+                snapshot_config = dataclasses.replace(config, backup_paths=paths, work_dir=work_dir)
+                create_exit = create_backup(snapshot_config, utils.CommandGenerator(snapshot_config, arguments),
+                                            env, run)
+
+            if create_exit <= 1 and manifest:
+                changes.write_manifest(config.manifest_file, manifest)
+            if create_exit <= 1 and not (config.do_prune and not arguments['--no-prune']):
+                delete_checkpoints(config, command_gen, env)
+
+        backup_exit = max(create_exit, run_hooks('post-create', config.post_create_hooks, config, run),
+                          backup_exit)
+        if backup_exit > 1:
+            raise utils.BorgCommandError(exit_code=backup_exit)
+
+    if pipeline is None:
+        finish_backup(config, arguments, command_gen, env, backup_exit, run)
+    else:
+        logger.info("Continuing backup procedure in the background, --pipeline option is set")
+        pipeline.submit(config, finish_backup, config, arguments, command_gen, env, backup_exit, run,
+                        lock)
+
+
+def scan_changes(config, run):
+    # Returns the manifest of the backup paths, or None if it matches the one of the last archive
+    with run.phase('scan_changes') as record:
+        manifest = changes.scan(config.backup_paths, config.scan_jobs)
+        changed = changes.changed_paths(manifest, changes.read_manifest(config.manifest_file))
+        record['changed'] = len(changed)
+
+    if not changed:
+        return None
 
+    logger.info(f"{len(changed)} of {len(manifest)} backup paths changed since the last archive")
+    logger.debug(utils.appendix("Changed backup paths are:", "\n".join(changed)))
+    return manifest
+
+
+def finish_backup(config, arguments, command_gen, env, backup_exit, run, lock=None):
+    # The lock is passed along to keep it held until the repository has been pruned
     if not config.do_prune or arguments['--no-prune']:
         logger.info("Repository won't be pruned, --no-prune option set or no keep options set")
-    elif (backup_exit := max(prune_repository(config, command_gen, env), backup_exit)) > 1:
-        raise utils.BorgCommandError(exit_code=backup_exit)
+    elif (backup_exit := max(run_hooks('pre-prune', config.pre_prune_hooks, config, run), backup_exit)) <= 1:
+        backup_exit = max(prune_repository(config, command_gen, env, run), backup_exit)
+        backup_exit = max(run_hooks('post-prune', config.post_prune_hooks, config, run), backup_exit)
+
+    if not (config.do_compact or config.do_check) or arguments['--no-maintenance']:
+        logger.info("Repository won't be maintained, --no-maintenance option set or nothing enabled")
+    elif backup_exit <= 1:
+        backup_exit = max(maintain_repository(config, command_gen, env, run), backup_exit)
+
+    if config.save_status:
+        with run.phase('save_status'):
+            save_status(config, command_gen, env)
 
     if backup_exit > 0:
         raise utils.BorgCommandError(exit_code=backup_exit)
     logger.info("Successfully completed backup procedure")
 
 
-if __name__ == "__main__":
-    arguments = docopt(__doc__, version='backup.py 0.5')
+def run_hooks(stage, hooks, config, run) -> int:
+    # Returns the highest exit code the failure policies of the hooks map their failures to
+    if not hooks:
+        return 0
+
+    logger.info(f"Running {len(hooks)} {stage} hooks")
+    ordered, lock = [h for h in hooks if h.ordered], threading.Lock()
+
+    def run_ordered():
+        exit_code = 0
+        for hook in ordered:
+            if (exit_code := max(run_hook(stage, hook, config, lock), exit_code)) > 1:
+                logger.warning(f"Skipping the remaining ordered {stage} hooks")
+                break
+        return exit_code
+
+    with run.phase(f"{stage.replace('-', '_')}_hooks", hooks=len(hooks)) as record:
+        with futures.ThreadPoolExecutor(max_workers=len(hooks), thread_name_prefix="hook") as pool:
+            pending = [pool.submit(cfg.with_context(run_hook), stage, h, config, lock) for h in hooks
+                       if not h.ordered]
+            pending += [pool.submit(cfg.with_context(run_ordered))] if ordered else []
+            record['hook_exit_code'] = exit_code = max(future.result() for future in pending)
+
+    return exit_code
+
+
+def run_hook(stage, hook, config, lock) -> int:
+    timeout = hook.timeout if hook.timeout is not None else config.hook_timeout
+    logger.debug(f"Running {stage} hook '{hook.command}', timeout={timeout}")
+    env = {**os.environ, 'BACKUP_NAME': config.log_name, 'BACKUP_STAGE': stage}
+    start = time.monotonic()
 
-    config = Config(os.path.expanduser(arguments['CONFIG']))
-    init_logging(config, arguments)
+    # The hook gets its own process group, so a timeout also kills the commands it started
+    with sp.Popen(hook.command, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT, env=env,
+                  start_new_session=True) as proc:
+        try:
+            output, _ = proc.communicate(timeout=timeout)
+        except sp.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            output, _ = proc.communicate()
+            logger.warning(f"The {stage} hook '{hook.command}' timed out after {timeout} seconds")
+
+    with lock, logsink.RotatingLog(config.borg_log, config.borg_log_size, config.borg_log_count,
+                                   config.borg_log_compression) as log:
+        log.write(f"[{dt.now():%Y-%m-%d %H:%M:%S}] {stage} hook '{hook.command}' exited with "
+                  f"{proc.returncode} after {time.monotonic() - start:.1f}s\n".encode() + output + b"\n")
+
+    if proc.returncode == 0:
+        return 0
+
+    policy = {'error': 2, 'warning': 1, 'ignore': 0}[hook.on_failure]
+    message = f"The {stage} hook '{hook.command}' failed, exit_code={proc.returncode}"
+    if policy == 2:
+        logger.error(message)
+        slack.error(f"Backup procedure failed: {message}")
+    elif policy == 1:
+        logger.warning(message)
+        slack.warning(message)
+    else:
+        logger.info(message)
+    return policy
+
+
+def maintain_repository(config, command_gen, env, run) -> int:
+    logger.info(f"Maintaining the repository, budget={config.maintenance_budget} minutes")
+    deadline = time.monotonic() + config.maintenance_budget * 60
+    state = read_maintenance_state(config.maintenance_file)
+    exit_code = 0
+
+    try:
+        if config.do_compact and time.time() - state['compacted'] >= config.compact_interval * 86400:
+            with run.phase('compact_repository') as record:
+                code = run_borg_command(command_gen.compact(), config, env, None, deadline - time.monotonic())
+                record['exit_code'] = code
+
+            if code is None:
+                logger.warning("Compacting the repository exceeded the maintenance budget")
+            elif (exit_code := max(code, exit_code)) <= 1:
+                state['compacted'] = time.time()
+            else:
+                slack.error("An error occurred while compacting the repository")
+
+        if config.do_check and (budget := deadline - time.monotonic()) >= 1:
+            exit_code = max(check_repository(config, command_gen, env, run, state, budget), exit_code)
+    finally:
+        write_maintenance_state(config.maintenance_file, state)
+
+    return exit_code
+
+
+def check_repository(config, command_gen, env, run, state, budget) -> int:
+    # borg remembers where a segment check with --max-duration stopped, archives are tracked here
+    deadline = time.monotonic() + budget
+    max_duration = max(1, int(budget * config.check_repository_share))
+
+    with run.phase('check_repository', max_duration=max_duration) as record:
+        code = run_borg_command(command_gen.check_repository(max_duration), config, env, None, budget)
+        record['exit_code'] = code
+
+    if code is not None and code > 0:
+        slack.error("The repository check found problems, consult the borg log for further info")
+        return code
+
+    _, archives = checkpoints(config, command_gen, env)
+    for key in ['verified', 'attempted']:
+        state[key] = {k: v for k, v in state[key].items() if k in archives}
+    exit_code, interrupted = 0, None
+
+    # Interrupted attempts count as well, so an archive that doesn't fit the budget doesn't block the others
+    with run.phase('verify_archives', verified=0) as record:
+        for archive in sorted(archives, key=lambda a: (max(state['verified'].get(a, 0),
+                                                           state['attempted'].get(a, 0)), a)):
+            if (remaining := deadline - time.monotonic()) < 1:
+                break
+            if (code := run_borg_command(command_gen.verify_archive(archive), config, env, None,
+                                         remaining)) is None:
+                logger.info(f"Verifying the archive '{archive}' exceeded the maintenance budget")
+                state['attempted'][archive], interrupted = time.time(), archive
+                break
+
+            if code == 0:
+                state['verified'][archive] = time.time()
+                state['attempted'].pop(archive, None)
+                record['verified'] += 1
+            else:
+                slack.error(f"Verifying the archive '{archive}' failed, exit_code={code}")
+                exit_code = max(code, exit_code)
+
+    logger.info(f"Verified {record['verified']} of {len(archives)} archives")
+    if record['verified'] == 0 and interrupted is not None:
+        logger.warning(f"Verifying '{interrupted}' didn't fit the maintenance budget, no archive was verified")
+        slack.warning("No archive could be verified within the maintenance budget")
+    return exit_code
+
+
+def read_maintenance_state(path) -> dict:
+    state = {'compacted': 0, 'verified': {}, 'attempted': {}}
+    try:
+        with open(path, 'r') as f:
+            state.update(json.load(f))
+    except (OSError, ValueError) as e:
+        logger.debug(f"Starting without a maintenance state: {e}")
+    return state
+
+
+def write_maintenance_state(path, state):
+    try:
+        with open(path + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Unable to save the maintenance state '{path}': {e}")
+
+
+def save_status(config, command_gen, env):
+    # The repository changed even if prune failed after the archive had been created
+    if (info := query_borg(command_gen.info(), config, env)) is None or \
+            (listing := query_borg(command_gen.list_archives(), config, env)) is None:
+        return logger.warning("Unable to save the repository status")
+
+    status = {'name': config.log_name, 'timestamp': time.time(), 'info': info, 'list': listing}
+    try:
+        with open(config.status_file + ".tmp", 'w') as f:
+            json.dump(status, f)
+        os.replace(config.status_file + ".tmp", config.status_file)
+        logger.debug(f"Saved the repository status, status_file='{config.status_file}'")
+    except OSError as e:
+        logger.warning(f"Unable to save the repository status: {e}")
+
+
+def read_status(status_file) -> dict:
+    with open(status_file, 'r') as f:
+        status = json.load(f)
+
+    stats = status['info'].get('cache', {}).get('stats', {})
+    archives = sorted(status['list'].get('archives', []), key=lambda a: a.get('time', ""))
+    last = archives[-1] if archives else {}
+
+    return {
+        'name': status['name'],
+        'saved': dt.fromtimestamp(status['timestamp']).isoformat(timespec='seconds'),
+        'repository': status['info'].get('repository', {}).get('location'),
+        'archives': len(archives),
+        'last_archive': last.get('name'),
+        'last_archive_time': last.get('time'),
+        'original_size': stats.get('total_size'),
+        'compressed_size': stats.get('total_csize'),
+        'deduplicated_size': stats.get('unique_csize'),
+    }
+
+
+def show_status(paths, arguments) -> int:
+    # Runs before logging is set up, so only the status files of the configs are resolved
+    statuses, exit_code = [], 0
+    for path in cfg.config_files(paths):
+        try:
+            statuses.append(read_status(cfg.Config.peek(path, 'status_file')['status_file']))
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"No repository status for '{path}': {e}")
+            exit_code = 2
+
+    if arguments['--json']:
+        print(json.dumps(statuses, indent=2))
+        return exit_code
+
+    for status in statuses:
+        sizes = {k: borg_stats.format_size(v) if v is not None else "?" for k, v in status.items()
+                 if k.endswith("_size")}
+        print(f"{status['name']}: {status['repository']}, saved {status['saved']}\n"
+              f"    {status['archives']} archives, last {status['last_archive']} at "
+              f"{status['last_archive_time']}\n"
+              f"    original {sizes['original_size']}, compressed {sizes['compressed_size']}, "
+              f"deduplicated {sizes['deduplicated_size']}")
+    return exit_code
+
+
+def run_stage(stage, *args) -> int:
+    try:
+        stage(*args)
+        return 0
+    except utils.BorgCommandError as e:
+        if e.is_error:
+            logger.error("Aborting backup procedure, consult the borg log for further info")
+        return e.exit_code
+    except Exception as e:
+        logger.error(utils.append_tb("An exception occurred during the backup procedure"))
+        return 2
+
+
+class PrunePipeline(object):
+    # Prunes the repository of one config while the archive of the next one is being created
+    def __init__(self):
+        self.executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="prune")
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, config, stage, *args):
+        self.pending[config.lock_file] = self.executor.submit(cfg.with_context(run_stage), stage, *args)
+
+    def exit_code(self, config) -> int:
+        return 0 if (future := self.pending.pop(config.lock_file, None)) is None else future.result()
+
+
+def run_backup(config, arguments, run, pipeline=None) -> int:
     exit_code, do_continue = 0, True
+    schedule = utils.RetrySchedule(config)
 
     while do_continue:
         do_continue = False
 
         try:
-            main(config, arguments)
+            main(config, arguments, run, pipeline)
         except utils.ConnectionError as e:
-            if not arguments['--no-schedule']:
+            if arguments['--no-schedule']:
+                logger.error(f"Aborting backup procedure, --no-schedule option is set")
+            elif not config.do_schedule:
+                exit_code = 2
+                logger.error("Aborting backup procedure, reruns are disabled as the backup delay is 0")
+                slack.error("Backup procedure failed: The ssh server could not be reached")
+            elif (delay := schedule.next_delay()) is None:
+                exit_code = 2
+                logger.error(f"Aborting backup procedure, giving up after {schedule.attempts} attempts")
+                slack.error("Backup procedure failed: Giving up on reaching the ssh server")
+            else:
                 do_continue = True
-                logger.warning(f"Scheduling backup to be rerun in {config.backup_delay} minutes")
+                logger.warning(f"Scheduling backup to be rerun in {delay / 60:.1f} minutes, "
+                               f"attempt={schedule.attempts}")
                 slack.info("Scheduling backup to be rerun")
-            else:
-                logger.error(f"Aborting backup procedure, --no-schedule option is set")
         except utils.BorgCommandError as e:
             exit_code = e.exit_code
             if e.is_error:
@@ -170,17 +671,110 @@ if __name__ == "__main__":
         except utils.SingleInstanceError as e:
             exit_code = 2
             logger.error("Aborting backup procedure, another instance may already be running")
+        except utils.MountPointError as e:
+            exit_code = 2
+            logger.error("Aborting backup procedure, not all devices could be mounted")
+        except utils.SnapshotError as e:
+            exit_code = 2
+            logger.error(f"Aborting backup procedure, the snapshots could not be taken: {e}")
+            slack.error("Backup procedure failed: The snapshots could not be taken")
         except Exception as e:
             exit_code = 2
-            logger.error(append_tb("An exception occurred during the backup procedure"))
+            logger.error(utils.append_tb("An exception occurred during the backup procedure"))
 
         if do_continue:
             try:
-                utils.trusty_sleep(config.backup_delay * 60)
+                run.retries += 1
+                with run.phase('retry_sleep', attempt=schedule.attempts):
+                    utils.trusty_sleep(delay)
             except KeyboardInterrupt:
                 logger.warning("Received keyboard interrupt, backup won't be rerun")
                 exit_code, do_continue = 2, False
 
+    return exit_code
+
+
+def run_serial(configs, arguments) -> list:
+    pipelined = arguments['--pipeline'] and len(configs) > 1
+    runs = []
+
+    with PrunePipeline() if pipelined else contextlib.nullcontext() as pipeline:
+        for config in configs:
+            run = metrics.RunMetrics(config.log_name)
+            runs.append((config, run, cfg.in_context(config.log_name, run_backup, config, arguments, run, pipeline)))
+
+    if pipelined:
+        runs = [(config, run, max(code, pipeline.exit_code(config))) for config, run, code in runs]
+
+    for config, run, exit_code in runs:
+        run.finish(exit_code)
+        if config.metrics_file is not None:
+            run.save(config.metrics_file)
+        if config.prometheus_file is not None:
+            run.export(config.prometheus_file)
+
+    return [(config, exit_code) for config, _, exit_code in runs]
+
+
+def tune_compression(config, arguments) -> int:
+    logger.info(f"Benchmarking compressors for '{config.log_name}'")
+
+    report = tuning.tune(config.backup_paths, int(arguments['--samples']), float(arguments['--min-speed']))
+    if not report['paths']:
+        logger.error("Unable to sample any files below the backup paths")
+        return 2
+
+    tuning.save(report, config.compression_file)
+    print(tuning.format_report(report))
+    logger.info(f"Saved the benchmark results, compression_file='{config.compression_file}'")
+    return 0
+
+
+def run_parallel(configs, arguments) -> list:
+    groups = {}
+    for config in configs:
+        groups.setdefault(utils.resource_key(config), []).append(config)
+
+    jobs = max(1, int(arguments['--jobs']))
+    logger.info(f"Backing up {len(configs)} repositories in {len(groups)} groups, jobs={jobs}")
+
+    # Pipelining within a group would overlap repositories that share a disk or an ssh link
+    if arguments['--pipeline']:
+        logger.warning("Ignoring the --pipeline option, it only applies with --jobs 1")
+        arguments = {**arguments, '--pipeline': False}
+    logger.debug(utils.appendix("Repositories are grouped as follows:",
+                                {k: [c.log_name for c in v] for k, v in groups.items()}))
+
+    with futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="backup") as pool:
+        pending = [pool.submit(run_serial, group, arguments) for group in groups.values()]
+        return [result for future in pending for result in future.result()]
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__, version='backup.py 0.5')
+
+    if arguments['status']:
+        sys.exit(show_status(arguments['CONFIG'], arguments))
+
+    configs = cfg.load_configs(arguments['CONFIG'], arguments['--refresh-paths'])
+    cfg.init_logging(configs, arguments)
+    logger.debug(f"Loaded {len(configs)} configs {time.monotonic() - started:.3f}s after startup")
+
+    if arguments['compression']:
+        sys.exit(max([cfg.in_context(config.log_name, tune_compression, config, arguments) for config in configs]))
+
+    try:
+        if len(configs) == 1 or int(arguments['--jobs']) <= 1:
+            results = run_serial(configs, arguments)
+        else:
+            results = run_parallel(configs, arguments)
+            for config, code in results:
+                logger.info(f"Backup procedure for '{config.log_name}' exited with exit code {code}")
+    finally:
+        for config in configs:
+            utils.close_ssh_master(config)
+
+    exit_code = max(code for _, code in results)
 
     logging.getLogger('log').debug(f"Program exited with exit code {exit_code}")
     logging.getLogger('clean').debug("")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import stat
+from concurrent import futures
+
+logger = logging.getLogger(__name__)
+
+
+def digest(path) -> str:
+    # Hashes path, inode, mtime and size of every entry, directory mtimes reveal deleted entries
+    hasher = hashlib.blake2b(digest_size=20)
+    pending = [path]
+
+    while pending:
+        try:
+            info = os.lstat(current := pending.pop())
+        except OSError as e:
+            hasher.update(f"{current}\0{e.errno}\n".encode(errors='surrogateescape'))
+            continue
+
+        hasher.update(f"{current}\0{info.st_ino}\0{info.st_mtime_ns}\0{info.st_size}\0{info.st_mode}\n"
+                      .encode(errors='surrogateescape'))
+
+        if stat.S_ISDIR(info.st_mode):
+            try:
+                with os.scandir(current) as entries:
+                    pending += sorted((entry.path for entry in entries), reverse=True)
+            except OSError as e:
+                hasher.update(f"{current}\0{e.errno}\n".encode(errors='surrogateescape'))
+
+    return hasher.hexdigest()
+
+
+def scan(paths, jobs) -> dict:
+    with futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="scan") as pool:
+        return dict(zip(paths, pool.map(digest, paths)))
+
+
+def read_manifest(path) -> dict:
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug(f"Unable to read the manifest '{path}': {e}")
+        return {}
+
+
+def write_manifest(path, manifest):
+    try:
+        with open(path + ".tmp", 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logger.warning(f"Unable to write the manifest '{path}': {e}")
+
+
+def changed_paths(manifest, previous) -> list:
+    return [path for path, value in manifest.items() if previous.get(path) != value] + \
+        [path for path in previous if path not in manifest]
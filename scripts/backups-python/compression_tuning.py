@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import lzma
+import os
+import random
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2097152  # = 2MB, borg's average chunk size
+MAX_FILES = 100000
+AUTO_THRESHOLD = 0.97
+ZSTD_LEVELS = [1, 3, 6, 10, 15]
+
+
+def compressors():
+    # Maps borg compression specs to the equivalent python compressor, if its module is installed
+    candidates = {
+        'none': lambda data: data,
+        'zlib,6': lambda data: zlib.compress(data, 6),
+        'lzma,6': lambda data: lzma.compress(data, preset=6),
+    }
+
+    try:
+        import lz4.block
+        candidates['lz4'] = lz4.block.compress
+    except ImportError:
+        logger.warning("The lz4 module is not installed, lz4 and auto won't be benchmarked")
+
+    try:
+        import zstandard
+        for level in ZSTD_LEVELS:
+            candidates[f"zstd,{level}"] = zstandard.ZstdCompressor(level=level).compress
+    except ImportError:
+        logger.warning("The zstandard module is not installed, zstd won't be benchmarked")
+
+    return candidates
+
+
+def sample_files(path, count, rng):
+    # Reservoir sample of the regular files below path, the walk is capped at MAX_FILES files
+    sample, seen = [], 0
+
+    for root, dirs, files in os.walk(path) if os.path.isdir(path) else [("", [], [path])]:
+        for name in files:
+            if not os.path.isfile(file := os.path.join(root, name)) or os.path.islink(file):
+                continue
+
+            if len(sample) < count:
+                sample.append(file)
+            elif (i := rng.randrange(seen + 1)) < count:
+                sample[i] = file
+
+            if (seen := seen + 1) >= MAX_FILES:
+                return sample
+    return sample
+
+
+def read_chunk(file, rng):
+    # Reads one chunk from a random offset, so file headers don't dominate the sample
+    try:
+        with open(file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(rng.randrange(max(1, size - CHUNK_SIZE + 1)))
+            return f.read(CHUNK_SIZE)
+    except OSError as e:
+        logger.debug(f"Unable to sample '{file}': {e}")
+        return b""
+
+
+def measure(chunks, candidates):
+    # Returns the compressed size and compression time of every chunk for each candidate
+    measurements = {}
+    for name, compress in candidates.items():
+        sizes, times = [], []
+        for chunk in chunks:
+            start = time.perf_counter()
+            sizes.append(len(compress(chunk)))
+            times.append(time.perf_counter() - start)
+        measurements[name] = (sizes, times)
+
+    # borg's auto only uses the given compression if lz4 finds a chunk to be compressible
+    if 'lz4' in measurements:
+        lz4_sizes, lz4_times = measurements['lz4']
+        for name in [n for n in measurements if n not in ['none', 'lz4']]:
+            sizes, times = measurements[name]
+            compressible = [lz4_sizes[i] < len(c) * AUTO_THRESHOLD for i, c in enumerate(chunks)]
+            measurements[f"auto,{name}"] = (
+                [sizes[i] if compressible[i] else len(c) for i, c in enumerate(chunks)],
+                [lz4_times[i] + (times[i] if compressible[i] else 0) for i in range(len(chunks))])
+
+    return measurements
+
+
+def summarize(chunks, measurements):
+    original = sum(len(c) for c in chunks)
+    return {name: {
+        'ratio': round(sum(sizes) / original, 4) if original > 0 else 1.0,
+        'speed': round(original / 1e6 / max(sum(times), 1e-6), 1),
+    } for name, (sizes, times) in measurements.items()}
+
+
+def recommend(results, min_speed):
+    # The best ratio among the candidates that compress at least min_speed MB/s per core
+    if not (fast := {k: v for k, v in results.items() if v['speed'] >= min_speed}):
+        return max(results, key=lambda k: results[k]['speed'])
+    return min(fast, key=lambda k: (fast[k]['ratio'], -fast[k]['speed']))
+
+
+def tune(paths, samples, min_speed, seed=None):
+    rng = random.Random(seed)
+    candidates = compressors()
+    report = {'min_speed': min_speed, 'paths': {}}
+    all_chunks, all_measurements = [], {}
+
+    for path in paths:
+        chunks = [c for f in sample_files(path, samples, rng) if (c := read_chunk(f, rng))]
+        logger.info(f"Sampled {len(chunks)} chunks from '{path}'")
+        if not chunks:
+            continue
+
+        measurements = measure(chunks, candidates)
+        results = summarize(chunks, measurements)
+        report['paths'][path] = {'chunks': len(chunks), 'results': results,
+                                 'recommendation': recommend(results, min_speed)}
+
+        all_chunks += chunks
+        for name, (sizes, times) in measurements.items():
+            all_sizes, all_times = all_measurements.setdefault(name, ([], []))
+            all_sizes += sizes
+            all_times += times
+
+    if all_chunks:
+        report['results'] = summarize(all_chunks, all_measurements)
+        report['recommendation'] = recommend(report['results'], min_speed)
+    return report
+
+
+def save(report, path):
+    report = {'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), **report}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def recommended(path, fallback):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)['recommendation']
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"No tuned compression in '{path}', using {fallback}: {e}")
+        return fallback
+
+
+def format_report(report):
+    lines = []
+    for path, entry in report['paths'].items():
+        lines.append(f"{path} ({entry['chunks']} chunks), recommended: {entry['recommendation']}")
+        for name, result in sorted(entry['results'].items(), key=lambda x: x[1]['ratio']):
+            lines.append(f"    {name:<16} ratio {result['ratio']:6.3f}  speed {result['speed']:8.1f} MB/s")
+    if 'recommendation' in report:
+        lines.append(f"Recommended compression for all paths: {report['recommendation']}")
+    return "\n".join(lines)
@@ -1,227 +1,355 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextvars
+import functools
 import glob
 import json
 import logging
-import logging.config
 import os
+from collections import namedtuple
+from dataclasses import dataclass, field, fields
 from os.path import dirname, expanduser, join
 
-import yaml
+from lazy import lazy_import
 
+dict_config = lazy_import('logging.config')
+futures = lazy_import('concurrent.futures')
+hashlib = lazy_import('hashlib')
+pickle = lazy_import('pickle')
+yaml = lazy_import('yaml')
 
-class Config(object):
-    def __init__(self, path):
-        self.config = Config.load_config(default_config())
-        Config.merge(self.config, Config.load_config(path))
 
-        if self.repo_path is None:
-            raise ValueError("Repository path must not be null")
+class ConfigError(ValueError):
+    def __init__(self, path, errors):
+        super().__init__(f"Invalid config '{path}'" + "".join(f"\n  - {e}" for e in errors))
+        self.path = path
+        self.errors = errors
 
-        if self.backup_paths is None or self.backup_paths == []:
-            raise ValueError("At least one backup path must be specified")
 
-        if self.use_ssh and (self.ssh_host is None or self.ssh_user is None):
-            raise ValueError("If use-ssh ist True, ssh host and user must not be null")
+def option(keys, convert=None, default=None):
+    # keys=None marks a value that is derived from the options declared before it
+    return field(metadata={'keys': keys, 'convert': convert, 'default': default})
 
-        any(self.expand_user(*keys) for keys in [
-            ('backup', 'paths'), ('backup', 'ensure-mounted'), ('backup', 'lock-file'), 
-            ('backup', 'patterns-from'), ('repository', 'path'), ('repository', 'key-file'),
-            ('repository', 'passphrase-file'), ('ssh', 'key-file'), ('logging', 'directory'),
-            ('logging', 'log-file'), ('logging', 'borg-log'), ('logging', 'slack-hook-file')])
 
-        self.set([x for p in self.backup_paths for x in glob.glob(p)], 'backup', 'paths')
+def string(value):
+    if not isinstance(value, str):
+        raise TypeError(f"expected a string, got {value!r}")
+    return value
 
-    @property
-    def log_name(self):
-        return self.get('logging', 'name', default="backup")
 
-    @property
-    def log_dir(self):
-        return self.get('logging', 'directory', default="/var/log/backups")
+def integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(f"expected an integer, got {value!r}")
+    return value
 
-    @property
-    def slack_hook(self):
-        if self.slack_hook_file is not None:
-            with open(self.slack_hook_file, 'r') as f:
-                return f.readline().rstrip()
-        else:
-            return self.get('logging', 'slack-hook')
 
-    @property
-    def slack_hook_file(self):
-       return self.get('logging', 'slack-hook-file')
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"expected a number, got {value!r}")
+    return value
 
-    @property
-    def log_base(self):
-        return join(self.log_dir, self.log_name)
 
-    @property
-    def log_file(self):
-        return self.get('logging', 'log-file', default=self.log_base + ".log")
+def boolean(value):
+    if not isinstance(value, bool):
+        raise TypeError(f"expected yes or no, got {value!r}")
+    return value
 
-    @property
-    def borg_log(self):
-        return self.get('logging', 'borg-log', default=self.log_base + ".borg")
 
-    @property
-    def lock_file(self):
-        return self.get('backup', 'lock-file', default=join("/var/run", self.log_name) + "-backup.lock")
+def path(value):
+    return expanduser(string(value))
 
-    @property
-    def ssh_host(self):
-        return self.get('ssh', 'host')
 
-    @property
-    def ssh_port(self):
-        return self.get('ssh', 'port')
+def string_list(value):
+    if isinstance(value, str):
+        return (value,)
+    if not isinstance(value, list):
+        raise TypeError(f"expected a string or a list of strings, got {value!r}")
+    return tuple(map(string, value))
 
-    @property
-    def ssh_user(self):
-        return self.get('ssh', 'user')
 
-    @property
-    def ssh_key_file(self):
-       return self.get('ssh', 'key-file')
+def path_list(value):
+    return tuple(map(expanduser, string_list(value)))
 
-    @property
-    def repo_path(self):
-        return self.get('repository', 'path')
 
-    @property
-    def repo_key(self):
-        return self.get('repository', 'key-file')
+def choice(*choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError(f"expected one of {', '.join(map(str, choices))}, got {value!r}")
+        return value
+    return convert
 
-    @property
-    def repo_passphrase(self):
-        return self.get('repository', 'passphrase')
 
-    @property
-    def repo_passphrase_file(self):
-        return self.get('repository', 'passphrase-file')
+def fraction(value):
+    if not 0 <= number(value) <= 1:
+        raise ValueError(f"expected a number between 0 and 1, got {value!r}")
+    return value
 
-    @property
-    def ask_repo_passphrase(self):
-        return self.get('repository', 'ask-passphrase', default=False)
 
-    @property
-    def use_ssh(self):
-        return self.get('repository', 'use-ssh', default=False)
+def keep_units(value):
+    return tuple((unit, count) for unit in KEEP_UNITS
+                 if (count := integer(value.get(unit) or 0)) != 0)
 
-    @property
-    def backup_paths(self):
-        if isinstance(self.get('backup', 'paths'), str):
-            return [self.get('backup', 'paths')]
-        else:
-            return self.get('backup', 'paths')
 
-    @property
-    def ensure_mounted(self):
-        if isinstance(self.get('backup', 'ensure-mounted'), str):
-            return [self.get('backup', 'ensure-mounted')]
-        else:
-            return self.get('backup', 'ensure-mounted', default=[])
-
-    @property
-    def remote_ratelimit(self):
-        return self.get('repository', 'ratelimit', default=0)
-
-    @property
-    def backup_delay(self):
-        return self.get('backup', 'delay', default=0)
-
-    @property
-    def do_schedule(self):
-        return self.backup_delay != 0
-
-    @property
-    def moved_repo_ok(self):
-       return self.get('moved_repo_ok', default=True)
-
-    @property
-    def unknown_repo_ok(self):
-       return self.get('unknown_repo_ok', default=True)
-
-    @property
-    def archive_name(self):
-        return self.archive_prefix + self.archive_suffix
-
-    @property
-    def archive_prefix(self):
-        return self.get('backup', 'prefix', default="{hostname}")
-
-    @property
-    def archive_suffix(self):
-        return self.get('backup', 'suffix', default="-{now}")
-
-    @property
-    def archive_compression(self):
-        return self.get('backup', 'compression', default="lz4")
-
-    @property
-    def patterns_from(self):
-        return self.get('backup', 'patterns-from')
-
-    @property
-    def patterns(self):
-        if isinstance(self.get('backup', 'patterns'), str):
-            return [self.get('backup', 'patterns')]
-        return self.get('backup', 'patterns', default=[])
-
-    @property
-    def do_prune(self):
-        return any(v is not None for k, v in self.get('keep', default={}).items())
-
-    @property
-    def keep_within(self):
-        return self.get('keep', 'within')
-
-    @property
-    def keep_last(self):
-       return self.get('keep', 'last', default=0)
-
-    def keep_unit(self, unit):
-        return self.get('keep', unit, default=0)
-
-    def get(self, *keys, default=None):
-        value = self.config
-        for key in keys:
-            if value is None or not isinstance(value, dict):
-                return default
-            value = value.get(key)
-
-        return default if value is None else value
-
-    def set(self, value, *keys):
-        if not keys:
-            raise ValueError("At least one key must be specified")
-
-        dictionary = self.config
-        for key in keys[:-1]:
-            if key not in dictionary or dictionary[key] is None:
-                dictionary[key] = {}
-            elif not isinstance(dictionary[key], dict):
-                raise ValueError(f"Cant set value {'/'.join(keys)}")
-            dictionary = dictionary[key]
-
-        dictionary[keys[-1]] = value
-
-    def expand_user(self, *keys):
-        if isinstance((value := self.get(*keys)), str):
-            self.set(expanduser(value), *keys)
-        elif isinstance(value, list):
-            self.set([expanduser(x) for x in value], *keys)
+def time_of_day(value):
+    # yaml reads unquoted times like 18:00 as base 60 integers, which are minutes already
+    minutes = value
+    if isinstance(value, str):
+        hours, _, minutes = value.partition(":")
+        try:
+            minutes = int(hours) * 60 + int(minutes or 0)
+        except ValueError:
+            minutes = None
+    if isinstance(minutes, bool) or not isinstance(minutes, int) or not 0 <= minutes <= 1440:
+        # An unquoted 25:00 arrives as 1500, so integers are shown as a time as well
+        shown = f"{value!r}" if isinstance(value, bool) or not isinstance(value, int) else \
+            f"{value} (={value // 60:02d}:{value % 60:02d})"
+        raise ValueError(f"expected a time of day between 00:00 and 24:00, got {shown}")
+    return minutes
+
+
+def ratelimit_windows(value):
+    # A single rate applies all day, otherwise the first window containing the time of day applies
+    if not isinstance(value, list):
+        return ((0, 1440, rate),) if (rate := integer(value)) != 0 else ()
+
+    windows = []
+    for window in value:
+        if not isinstance(window, dict):
+            raise TypeError(f"expected a mapping with from, to and rate, got {window!r}")
+        windows.append((time_of_day(window.get('from')), time_of_day(window.get('to')),
+                        integer(window.get('rate'))))
+    return tuple(windows)
+
+
+def cpu_list(value):
+    # Passed to taskset --cpu-list, e.g. 0-3,6 or [0, 1]
+    if isinstance(value, list):
+        return ",".join(str(integer(cpu)) for cpu in value)
+    return str(integer(value)) if not isinstance(value, str) else value
+
+
+def memory_size(value):
+    # Passed to systemd, e.g. 2G or a number of bytes
+    return value if isinstance(value, str) else str(integer(value))
+
+
+Hook = namedtuple('Hook', ['command', 'timeout', 'ordered', 'on_failure'])
+
+
+def hooks(value):
+    # A hook is a command or a mapping with a command and its timeout, order and failure policy
+    result = []
+    for hook in [value] if isinstance(value, (str, dict)) else value:
+        hook = {'command': hook} if isinstance(hook, str) else hook
+        if not isinstance(hook, dict) or not isinstance(hook.get('command'), str):
+            raise TypeError(f"expected a command or a mapping with a command, got {hook!r}")
+
+        result.append(Hook(
+            hook['command'],
+            number(hook['timeout']) if hook.get('timeout') is not None else None,
+            boolean(hook.get('ordered', False)),
+            choice('error', 'warning', 'ignore')(hook.get('on-failure', 'error'))))
+    return tuple(result)
+
+
+def keep_any(value):
+    return any(v is not None for v in value.values())
+
+
+log_context = contextvars.ContextVar('log_context', default=None)
+
+KEEP_UNITS = ['secondly', 'minutely', 'hourly', 'daily', 'weekly', 'monthly', 'yearly']
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    log_name: str = option(('logging', 'name'), string, "backup")
+    log_dir: str = option(('logging', 'directory'), path, "/var/log/backups")
+    log_base: str = option(None, default=lambda c: join(c['log_dir'], c['log_name']))
+    log_file: str = option(('logging', 'log-file'), path, lambda c: c['log_base'] + ".log")
+    borg_log: str = option(('logging', 'borg-log'), path, lambda c: c['log_base'] + ".borg")
+    borg_log_size: int = option(('logging', 'borg-log-size'), integer, 1048576)
+    borg_log_count: int = option(('logging', 'borg-log-count'), integer, 1)
+    borg_log_compression: str = option(('logging', 'borg-log-compression'), choice('gzip', 'zstd'))
+    borg_progress: bool = option(('logging', 'progress'), boolean, False)
+    stats_file: str = option(('logging', 'stats-file'), path, lambda c: c['log_base'] + ".stats")
+    metrics_file: str = option(('logging', 'metrics-file'), path)
+    save_status: bool = option(('logging', 'status'), boolean, True)
+    status_file: str = option(('logging', 'status-file'), path, lambda c: c['log_base'] + ".status")
+    prometheus_file: str = option(('logging', 'prometheus-file'), path)
+    slack_hook_file: str = option(('logging', 'slack-hook-file'), path)
+    slack_hook: str = option(('logging', 'slack-hook'), string, lambda c: read_hook(c['slack_hook_file']))
+    slack_capacity: int = option(('logging', 'slack-capacity'), integer)
+    slack_interval: float = option(('logging', 'slack-interval'), number)
+    slack_timeout: float = option(('logging', 'slack-timeout'), number)
+
+    backup_paths: tuple = option(('backup', 'paths'), path_list)
+    path_cache: bool = option(('backup', 'path-cache'), boolean, False)
+    path_cache_file: str = option(('backup', 'path-cache-file'), path, lambda c: c['log_base'] + ".paths")
+    ensure_mounted: tuple = option(('backup', 'ensure-mounted'), path_list, ())
+    mount_timeout: float = option(('backup', 'mount-timeout'), number, 30)
+    mount_command: str = option(('backup', 'mount-command'), string, "mount")
+    check_timeout: float = option(('backup', 'check-timeout'), number, 60)
+    archive_prefix: str = option(('backup', 'prefix'), string, "{hostname}")
+    archive_suffix: str = option(('backup', 'suffix'), string, "-{now}")
+    archive_name: str = option(None, default=lambda c: c['archive_prefix'] + c['archive_suffix'])
+    archive_compression: str = option(('backup', 'compression'), string, "lz4")
+    compression_file: str = option(('backup', 'compression-file'), path,
+                                   lambda c: c['log_base'] + ".compression")
+    checkpoint_interval: int = option(('backup', 'checkpoint-interval'), integer, 1800)
+    resume_checkpoints: bool = option(('backup', 'resume'), boolean, True)
+    interrupted_file: str = option(None, default=lambda c: c['log_base'] + ".interrupted")
+    patterns_from: str = option(('backup', 'patterns-from'), path)
+    patterns: tuple = option(('backup', 'patterns'), string_list, ())
+    exclude_caches: bool = option(('backup', 'exclude-caches'), boolean, True)
+    exclude_known_caches: bool = option(('backup', 'exclude-known-caches'), boolean, False)
+    exclude_if_present: tuple = option(('backup', 'exclude-if-present'), string_list, ())
+    skip_unchanged: bool = option(('backup', 'skip-unchanged'), boolean, False)
+    manifest_file: str = option(('backup', 'manifest-file'), path, lambda c: c['log_base'] + ".manifest")
+    scan_jobs: int = option(('backup', 'scan-jobs'), integer, 4)
+    lock_file: str = option(('backup', 'lock-file'), path,
+                            lambda c: join("/var/run", c['log_name']) + "-backup.lock")
+    backup_delay: float = option(('backup', 'delay'), number, 0)
+    backup_backoff: float = option(('backup', 'backoff'), number, 2)
+    backup_max_delay: float = option(('backup', 'max-delay'), number, 0)
+    backup_jitter: float = option(('backup', 'jitter'), fraction, 0.2)
+    backup_max_attempts: int = option(('backup', 'max-attempts'), integer, 0)
+    backup_deadline: float = option(('backup', 'deadline'), number, 0)
+    do_schedule: bool = option(None, default=lambda c: c['backup_delay'] != 0)
+
+    repo_path: str = option(('repository', 'path'), path)
+    repo_key: str = option(('repository', 'key-file'), path)
+    repo_passphrase: str = option(('repository', 'passphrase'), string)
+    repo_passphrase_file: str = option(('repository', 'passphrase-file'), path)
+    ask_repo_passphrase: bool = option(('repository', 'ask-passphrase'), boolean, False)
+    use_ssh: bool = option(('repository', 'use-ssh'), boolean, False)
+    remote_ratelimit: tuple = option(('repository', 'ratelimit'), ratelimit_windows, ())
+    moved_repo_ok: bool = option(('repository', 'moved_repo_ok'), boolean, True)
+    unknown_repo_ok: bool = option(('repository', 'unknown_repo_ok'), boolean, True)
+
+    ssh_host: str = option(('ssh', 'host'), string)
+    ssh_port: int = option(('ssh', 'port'), integer)
+    ssh_user: str = option(('ssh', 'user'), string)
+    ssh_key_file: str = option(('ssh', 'key-file'), path)
+    ssh_multiplex: bool = option(('ssh', 'multiplex'), boolean, True)
+    ssh_control_path: str = option(('ssh', 'control-path'), path, lambda c: None if not (
+        c['use_ssh'] and c['ssh_multiplex']) else join(dirname(c['lock_file']), f"{c['log_name']}-ssh-%C"))
+    ssh_control_persist: int = option(('ssh', 'control-persist'), integer, 60)
+
+    nice: int = option(('resources', 'nice'), integer, 10)
+    ionice_class: str = option(('resources', 'ionice-class'), choice('none', 'idle', 'best-effort', 'realtime'),
+                               'best-effort')
+    ionice_priority: int = option(('resources', 'ionice-priority'), integer, 7)
+    cpu_affinity: str = option(('resources', 'cpu-affinity'), cpu_list)
+    memory_max: str = option(('resources', 'memory-max'), memory_size)
+
+    snapshot_type: str = option(('snapshots', 'type'), choice('none', 'auto', 'btrfs', 'zfs', 'lvm'), 'none')
+    snapshot_dir: str = option(('snapshots', 'directory'), path,
+                               lambda c: join("/run/backups-snapshots", c['log_name']))
+    snapshot_lvm_size: str = option(('snapshots', 'lvm-size'), string, "10%ORIGIN")
+    work_dir: str = option(None)
+
+    pre_create_hooks: tuple = option(('hooks', 'pre-create'), hooks, ())
+    post_create_hooks: tuple = option(('hooks', 'post-create'), hooks, ())
+    pre_prune_hooks: tuple = option(('hooks', 'pre-prune'), hooks, ())
+    post_prune_hooks: tuple = option(('hooks', 'post-prune'), hooks, ())
+    hook_timeout: float = option(('hooks', 'timeout'), number, 600)
+
+    do_compact: bool = option(('maintenance', 'compact'), boolean, False)
+    compact_interval: float = option(('maintenance', 'compact-interval'), number, 7)
+    do_check: bool = option(('maintenance', 'check'), boolean, False)
+    maintenance_budget: float = option(('maintenance', 'budget'), number, 60)
+    check_repository_share: float = option(('maintenance', 'repository-share'), fraction, 0.5)
+    maintenance_file: str = option(('maintenance', 'state-file'), path,
+                                   lambda c: c['log_base'] + ".maintenance")
+
+    do_prune: bool = option(('keep',), keep_any, False)
+    keep_within: str = option(('keep', 'within'), string)
+    keep_last: int = option(('keep', 'last'), integer, 0)
+    keep_units: tuple = option(('keep',), keep_units, ())
+
+    @classmethod
+    def load(cls, path, refresh_paths=False):
+        return cls.compile(Config.load_raw(path), path, refresh_paths)
+
+    @classmethod
+    def peek(cls, path, *names):
+        # Only the options up to the last of names are compiled, so neither is the slack hook read
+        # nor are the backup paths expanded
+        values, errors = cls.compile_values(Config.load_raw(path), set(names))
+        if errors:
+            raise ConfigError(path, errors)
+        return {name: values[name] for name in names}
+
+    @classmethod
+    def compile(cls, raw, path="<config>", refresh_paths=False):
+        values, errors = cls.compile_values(raw)
+
+        if values['repo_path'] is None:
+            errors.append("repository/path: must not be null")
+
+        if not values['backup_paths']:
+            errors.append("backup/paths: at least one backup path must be specified")
+
+        if values['use_ssh'] and (values['ssh_host'] is None or values['ssh_user'] is None):
+            errors.append("ssh: if use-ssh is set, ssh host and user must not be null")
+
+        if errors:
+            raise ConfigError(path, errors)
+
+        values['backup_paths'] = expand_paths(
+            values['backup_paths'], values['path_cache_file'] if values['path_cache'] else None,
+            refresh_paths)
+        return cls(**values)
+
+    @classmethod
+    def compile_values(cls, raw, names=None):
+        values, errors, failed = {}, [], set()
+
+        for f in fields(cls):
+            if names is not None and names <= values.keys():
+                break
+
+            keys, convert, default = f.metadata['keys'], f.metadata['convert'], f.metadata['default']
+            name = f.name if keys is None else "/".join(keys)
+
+            values[f.name] = None
+
+            try:
+                if keys is not None and (value := lookup(raw, keys)) is not None:
+                    values[f.name] = convert(value)
+                    continue
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                failed.add(f.name)
+                continue
+
+            try:
+                values[f.name] = default(dependencies := Dependencies(values)) if callable(default) else default
+            except Exception as e:
+                # Derived defaults fail as well if an option they depend on is invalid, that is reported already
+                if not dependencies.read & failed:
+                    errors.append(f"{name}: {e}")
+                failed.add(f.name)
+
+        return values, errors
+
+    @staticmethod
+    def load_raw(path):
+        raw = Config.load_config(default_config())
+        Config.merge(raw, Config.load_config(path))
+        return raw
 
     @staticmethod
     def load_config(path):
-        with open(path, 'r') as f:
-            if (extension := path.split('.')[-1]) in ['yaml', 'yml']:
-                return yaml.safe_load(f.read())
-            elif extension == 'json':
+        if (extension := path.split('.')[-1]) in ['yaml', 'yml']:
+            return load_yaml(path)
+        elif extension == 'json':
+            with open(path, 'r') as f:
                 return json.load(f)
-            else:
-                raise NotImplementedError("Config must be either yaml or json")
+        else:
+            raise NotImplementedError("Config must be either yaml or json")
 
     @staticmethod
     def merge(dict1, dict2):
@@ -234,6 +362,156 @@ class Config(object):
                 dict1[k] = v2
 
 
+class Dependencies(dict):
+    # Records the values a derived default reads
+    def __init__(self, values):
+        super().__init__(values)
+        self.read = set()
+
+    def __getitem__(self, key):
+        self.read.add(key)
+        return super().__getitem__(key)
+
+
+def lookup(raw, keys):
+    value = raw
+    for key in keys:
+        if value is None:
+            return None
+        if not isinstance(value, dict):
+            raise TypeError(f"expected a mapping at '{key}', got {value!r}")
+        value = value.get(key)
+    return value
+
+
+def read_hook(path):
+    if path is None:
+        return None
+    with open(path, 'r') as f:
+        return f.readline().rstrip()
+
+
+def load_yaml(path):
+    # Parsed yaml files are pickled, keyed on their path, mtime and size
+    stat = os.stat(path := os.path.abspath(path))
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cache_file = join(cache_dir(), hashlib.sha1(path.encode()).hexdigest() + ".pickle")
+
+    try:
+        with open(cache_file, 'rb') as f:
+            if (cached := pickle.load(f))['key'] == key:
+                return cached['data']
+    except Exception:
+        pass
+
+    with open(path, 'r') as f:
+        data = yaml.load(f.read(), Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+    try:
+        os.makedirs(cache_dir(), mode=0o700, exist_ok=True)
+        with open(cache_file + ".tmp", 'wb') as f:
+            pickle.dump({'key': key, 'data': data}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + ".tmp", cache_file)
+    except OSError:
+        pass
+
+    return data
+
+
+def cache_dir():
+    return join(os.environ.get('XDG_CACHE_HOME') or expanduser("~/.cache"), "backups-python")
+
+
+def expand_paths(patterns, cache_file=None, refresh=False):
+    cache = {} if cache_file is None or refresh else read_path_cache(cache_file)
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, min(len(patterns), 16))) as pool:
+        results = list(pool.map(lambda p: expand_path(p, cache.get(p)), patterns))
+
+    if cache_file is not None:
+        write_path_cache(cache_file, {p: entry for p, (_, entry) in zip(patterns, results)
+                                      if entry is not None})
+
+    return tuple(x for paths, _ in results for x in paths)
+
+
+def expand_path(pattern, entry=None):
+    # Matches of a pattern are cached by the mtimes of every directory the glob looked into, as a
+    # new entry only changes the mtime of the directory it was created in
+    if not glob.has_magic(pattern):
+        return glob.glob(pattern), None
+
+    if entry is not None and entry.get('mtimes') and \
+            all(directory_mtime(d) == mtime for d, mtime in entry['mtimes'].items()):
+        return entry['paths'], entry
+
+    parts = pattern.split(os.sep)
+    first = next(i for i, x in enumerate(parts) if glob.has_magic(x))
+    paths, mtimes = [os.sep.join(parts[:first]) or (os.sep if pattern.startswith(os.sep) else ".")], {}
+
+    for i, part in enumerate(parts[first:], first):
+        mtimes.update((p, mtime) for p in paths if (mtime := directory_mtime(p)) is not None)
+        paths = [match for p in paths for match in (
+            glob.glob(join(glob.escape(p), part)) if glob.has_magic(part) else
+            [join(p, part)] if os.path.lexists(join(p, part)) else [])]
+        if i < len(parts) - 1:
+            paths = [p for p in paths if os.path.isdir(p)]
+
+    if first == 0:
+        paths = [os.path.relpath(p) for p in paths]
+    return paths, {'mtimes': mtimes, 'paths': paths}
+
+
+def directory_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def read_path_cache(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_path_cache(path, cache):
+    try:
+        os.makedirs(dirname(path), exist_ok=True)
+        with open(path + ".tmp", 'w') as f:
+            json.dump(cache, f)
+        os.replace(path + ".tmp", path)
+    except OSError:
+        pass
+
+
+def config_files(paths):
+    files = []
+    for path in map(expanduser, paths):
+        if os.path.isdir(path):
+            files += sorted(join(path, f) for f in os.listdir(path)
+                            if f.split('.')[-1] in ['yaml', 'yml', 'json'])
+        else:
+            files.append(path)
+
+    if not files:
+        raise ValueError("No config files found")
+    return files
+
+
+def load_configs(paths, refresh_paths=False):
+    configs = [Config.load(path, refresh_paths) for path in config_files(paths)]
+
+    for attribute in ['lock_file', 'borg_log', 'prometheus_file']:
+        values = [value for c in configs if (value := getattr(c, attribute)) is not None]
+        if len(values) != len(set(values)):
+            raise ValueError(f"Configs must not share a {attribute}, consider setting logging/name")
+
+    return configs
+
+
 def default_config():
     return join(dirname(__file__), "default.yaml")
 
@@ -246,30 +524,76 @@ def borg_logging_config():
     return join(dirname(__file__), "borg-logging.ini")
 
 
-def init_logging(config, arguments):
-    with open(logging_config(), 'r') as f:
-        log_config = yaml.safe_load(f.read())
+def init_logging(configs, arguments):
+    log_config = load_yaml(logging_config())
+    default = configs[0].log_name if len(configs) == 1 else "-"
 
+    for config in configs:
         os.makedirs(config.log_dir, exist_ok=True)
+        os.makedirs(dirname(config.log_file) or ".", exist_ok=True)
+
+    # Every log file and slack hook gets its own handlers, records logged outside of a config go
+    # to the ones of the first config
+    for kind, attribute in [('log', 'log_file'), ('clean', 'log_file'), ('slack', 'slack_hook')]:
+        handler, names = log_config['handlers'].pop(kind), {}
+        for config in configs:
+            if (value := getattr(config, attribute)) is not None:
+                names.setdefault(value, []).append(config.log_name)
+
+        log_config['loggers'][kind]['handlers'] = []
+        for i, (value, users) in enumerate(names.items()):
+            log_config['filters'][name := kind if i == 0 else f"{kind}-{i}"] = {
+                '()': ConfigFilter, 'default': default,
+                'names': None if kind == 'clean' else users + [default] * (configs[0].log_name in users)}
+            log_config['handlers'][name] = {**handler, 'filters': [name]}
+            log_config['loggers'][kind]['handlers'].append(name)
+
+            if kind == 'slack':
+                # Options that aren't set keep the values of logging.yaml
+                config = next(c for c in configs if c.slack_hook == value)
+                log_config['handlers'][name].update({k: v for k, v in [
+                    ('url', value), ('capacity', config.slack_capacity), ('interval', config.slack_interval),
+                    ('timeout', config.slack_timeout)] if v is not None})
+            else:
+                log_config['handlers'][name]['filename'] = value
 
-        log_config['handlers']['log']['filename'] = config.log_file
-        log_config['handlers']['clean']['filename'] = config.log_file
-
-        if config.slack_hook is None:
-            log_config['loggers']['slack']['handlers'] = ['null-handler']
-        else:
-            log_config['handlers']['slack']['url'] = config.slack_hook
-            log_config['formatters']['slack']['format'] = \
-                log_config['formatters']['slack']['format'].format(config.log_name)
+    log_config['root']['handlers'] = ['console', *log_config['loggers']['log']['handlers']]
+    log_config['loggers']['slack']['handlers'] = log_config['loggers']['slack']['handlers'] or ['null-handler']
 
-        levels = ["debug", "info", "warning", "error", "critical"]
-        log_config['handlers']['console']['level'] = next(
-            (l for l in levels if arguments["--" + l]), "warning").upper()
+    levels = ["debug", "info", "warning", "error", "critical"]
+    log_config['filters']['console'] = {'()': ConfigFilter, 'default': default}
+    log_config['handlers']['console']['filters'] = ['console']
+    log_config['handlers']['console']['level'] = next(
+        (l for l in levels if arguments["--" + l]), "warning").upper()
 
-    logging.config.dictConfig(log_config)
+    dict_config.dictConfig(log_config)
     logging.getLogger("").handlers[0].addFilter(console_filter)
 
 
+class ConfigFilter(logging.Filter):
+    # Adds the name of the config a record was logged for, and only passes the records of names
+    def __init__(self, default, names=None):
+        super().__init__()
+        self.default = default
+        self.names = names
+
+    def filter(self, record):
+        record.config = log_context.get() or self.default
+        return self.names is None or record.config in self.names
+
+
+def in_context(name, func, *args):
+    # Records logged by func are attributed to the config name
+    context = contextvars.copy_context()
+    context.run(log_context.set, name)
+    return context.run(func, *args)
+
+
+def with_context(func):
+    # New threads start in an empty context, this carries the config name over to them
+    return functools.partial(contextvars.copy_context().run, func)
+
+
 def console_filter(record):
     if record.name.startswith("apscheduler") and record.levelno < 30:
         return 0
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    # Stands in for a module, which is only imported once one of its attributes is accessed
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self.__name__), attr)
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import fcntl
+import gzip
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+PIPE_SIZE = 1048576  # = 1MB
+
+
+class RotatingLog(object):
+    # Size bounded log file that rotates while it is being written to
+    def __init__(self, path, max_bytes=1048576, backup_count=1, compression=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress, self.extension = compressor(compression)
+        self.file = None
+        self.size = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self):
+        self.file = open(self.path, 'ab', buffering=PIPE_SIZE)
+        self.size = self.file.tell()
+
+        if self.max_bytes > 0 and self.size >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, data):
+        while self.max_bytes > 0 and self.size + len(data) > self.max_bytes:
+            # Rotate at the last line break that still fits into the current file
+            cut = self.max_bytes - self.size
+            if (newline := data.rfind(b"\n", 0, cut)) != -1:
+                cut = newline + 1
+
+            self.file.write(data[:cut])
+            data = data[cut:]
+            self.rotate()
+
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.close()
+
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                if os.path.exists(source := self.rotated(i)):
+                    os.replace(source, self.rotated(i + 1))
+
+            if self.compress is None:
+                os.replace(self.path, self.rotated(1))
+            else:
+                self.compress(self.path, self.rotated(1))
+                os.remove(self.path)
+        else:
+            os.remove(self.path)
+
+        self.file = open(self.path, 'ab', buffering=PIPE_SIZE)
+        self.size = 0
+
+    def rotated(self, index):
+        return f"{self.path}.{index}{self.extension}"
+
+
+def compressor(compression):
+    if compression is None:
+        return None, ""
+    elif compression == 'gzip':
+        return gzip_file, ".gz"
+    elif compression == 'zstd':
+        try:
+            import zstandard  # pylint: disable=unused-import
+            return zstd_file, ".zst"
+        except ImportError:
+            logger.warning("The zstandard module is not installed, compressing borg logs with gzip")
+            return gzip_file, ".gz"
+    raise ValueError(f"Unknown borg log compression '{compression}'")
+
+
+def gzip_file(source, destination):
+    with open(source, 'rb') as src, gzip.open(destination, 'wb') as dst:
+        shutil.copyfileobj(src, dst, PIPE_SIZE)
+
+
+def zstd_file(source, destination):
+    import zstandard
+
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        zstandard.ZstdCompressor().copy_stream(src, dst, read_size=PIPE_SIZE)
+
+
+def widen_pipe(pipe, size=PIPE_SIZE):
+    try:
+        fcntl.fcntl(pipe.fileno(), getattr(fcntl, 'F_SETPIPE_SZ', 1031), size)
+    except OSError:
+        logger.debug(f"Unable to resize the pipe to {size} bytes, using the default size")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import re
+import socket
+import time
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+logger = logging.getLogger(__name__)
+
+SUCCESS_RE = re.compile(r"^backup_last_success_timestamp_seconds(?:\{.*\})? (\S+)$", re.MULTILINE)
+SIZES = ['files', 'original_size', 'compressed_size', 'deduplicated_size']
+
+
+class RunMetrics(object):
+    # Records the duration of each phase of a backup run
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.started = time.monotonic()
+        self.ended = None
+        self.duration = None
+        self.exit_code = None
+        self.retries = 0
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, **fields):
+        record = {'phase': name, 'start': timestamp(time.time()), 'duration': None, **fields}
+        started = time.monotonic()
+
+        try:
+            yield record
+        finally:
+            self.ended = time.monotonic()
+            record['duration'] = round(self.ended - started, 3)
+            self.phases.append(record)
+            logger.debug(f"Phase {name} took {record['duration']:.3f}s")
+
+    def timed(self, name, func, **fields):
+        def run(*args, **kwargs):
+            with self.phase(name, **fields) as record:
+                record['ok'] = bool(result := func(*args, **kwargs))
+            return result
+        return run
+
+    def finish(self, exit_code):
+        # Pipelined runs are finished after the others, so they end with their last phase
+        self.exit_code = exit_code
+        self.duration = round((self.ended or time.monotonic()) - self.started, 3)
+
+    def summary(self):
+        return {
+            'name': self.name,
+            'host': socket.gethostname(),
+            'start': timestamp(self.start),
+            'duration': self.duration,
+            'exit_code': self.exit_code,
+            'retries': self.retries,
+            'phases': self.phases,
+        }
+
+    def save(self, path):
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(self.summary()) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to write the metrics file '{path}': {e}")
+
+    def export(self, path):
+        # Writes the prometheus text format for node_exporter's textfile collector
+        if self.exit_code is not None and self.exit_code <= 1:
+            last_success = self.start + self.duration
+        else:
+            last_success = previous_success(path)
+
+        gauges = {
+            'backup_last_success_timestamp_seconds': [({}, last_success)],
+            'backup_last_run_timestamp_seconds': [({}, self.start)],
+            'backup_duration_seconds': [({}, self.duration)],
+            'backup_exit_code': [({}, self.exit_code)],
+            'backup_retries': [({}, self.retries)],
+            'backup_phase_duration_seconds': [],
+            'backup_borg_exit_code': [],
+            'backup_hook_exit_code': [],
+        }
+
+        durations = {}
+        for record in self.phases:
+            durations[record['phase']] = durations.get(record['phase'], 0) + record['duration']
+
+            if record.get('exit_code') is not None:
+                gauges['backup_borg_exit_code'].append(({'phase': record['phase']}, record['exit_code']))
+            if record.get('hook_exit_code') is not None:
+                gauges['backup_hook_exit_code'].append(({'phase': record['phase']}, record['hook_exit_code']))
+            if record['phase'] == 'create_backup':
+                for key in SIZES:
+                    gauges[f"backup_{key.replace('size', 'bytes')}"] = [({}, record[key])]
+
+        gauges['backup_phase_duration_seconds'] = [({'phase': k}, v) for k, v in durations.items()]
+
+        lines = []
+        for metric, samples in gauges.items():
+            lines.append(f"# TYPE {metric} gauge")
+            for labels, value in samples:
+                if value is not None:
+                    lines.append(f"{metric}{{{format_labels(name=self.name, **labels)}}} {value}")
+
+        try:
+            with open(temporary := f"{path}.{os.getpid()}.tmp", 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(temporary, path)
+        except OSError as e:
+            logger.warning(f"Failed to write the prometheus file '{path}': {e}")
+
+
+def previous_success(path):
+    try:
+        with open(path, 'r') as f:
+            return float(match.group(1)) if (match := SUCCESS_RE.search(f.read())) else None
+    except (OSError, ValueError):
+        return None
+
+
+def format_labels(**labels):
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+
+def timestamp(seconds):
+    return dt.fromtimestamp(seconds).astimezone().isoformat(timespec='milliseconds')
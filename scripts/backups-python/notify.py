@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+
+class SlackQueueHandler(logging.Handler):
+    # Posts records to a slack webhook in batches, from a background thread
+    def __init__(self, url, capacity=100, interval=5, timeout=10, drop='oldest', level=logging.NOTSET):
+        super().__init__(level)
+
+        if drop not in ['oldest', 'newest']:
+            raise ValueError(f"Unknown drop policy '{drop}'")
+
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.drop = drop
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=capacity)
+        self.worker = threading.Thread(target=self.work, name="slack", daemon=True)
+        self.worker.start()
+
+    def emit(self, record):
+        try:
+            self.enqueue(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def enqueue(self, message):
+        while True:
+            try:
+                return self.queue.put_nowait(message)
+            except queue.Full:
+                self.dropped += 1
+                if self.drop == 'newest':
+                    return
+
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def close(self):
+        if not self.worker.is_alive():
+            return super().close()
+
+        # Draining the queue and sending the last batch share the timeout
+        deadline = time.monotonic() + self.timeout
+        try:
+            self.queue.put(None, timeout=self.timeout)
+            self.worker.join(max(0, deadline - time.monotonic()))
+            if self.worker.is_alive():
+                logger.warning("Timed out while sending the remaining slack messages")
+        except queue.Full:
+            logger.warning("Timed out while waiting for the slack queue to drain")
+        finally:
+            super().close()
+
+    def work(self):
+        while (message := self.queue.get()) is not None:
+            batch, deadline = [message], time.monotonic() + self.interval
+
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    if (message := self.queue.get(timeout=remaining)) is None:
+                        return self.post(batch)
+                    batch.append(message)
+                except queue.Empty:
+                    break
+
+            self.post(batch)
+
+    def post(self, batch):
+        if self.dropped > 0:
+            batch, self.dropped = batch + [f"({self.dropped} messages were dropped)"], 0
+
+        request = urllib.request.Request(
+            self.url, data=json.dumps({'text': "\n".join(batch)}).encode(),
+            headers={'Content-Type': 'application/json'})
+
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except Exception as e:
+            logger.warning(f"Failed to send {len(batch)} messages to slack: {e}")
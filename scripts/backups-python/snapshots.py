@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import re
+import subprocess as sp
+from collections import namedtuple
+from os.path import join
+
+from utils import SnapshotError
+
+logger = logging.getLogger(__name__)
+
+Mount = namedtuple('Mount', ['point', 'fstype', 'source'])
+
+# Mount options that allow a snapshot of a mounted filesystem to be mounted a second time
+LVM_MOUNT_OPTIONS = {'xfs': "ro,nouuid", 'ext3': "ro,noload", 'ext4': "ro,noload"}
+
+
+class SnapshotSet(object):
+    # Snapshots the filesystems of the backup paths and mounts them read-only below root,
+    # everything that was set up is torn down again in reverse order when the context exits
+    def __init__(self, kind, root, name, lvm_size):
+        self.kind = kind
+        self.root = root
+        self.name = name
+        self.lvm_size = lvm_size
+        self.teardown = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def take(self, paths) -> tuple:
+        # Returns the directory borg has to run in and the backup paths relative to it, so the
+        # archive paths and anchored patterns are the same as without snapshots
+        if self.kind == 'none':
+            return None, paths
+
+        table = mount_table()
+        mounts = {(mount := find_mount(os.path.realpath(p), table)).point: mount for p in paths}
+
+        # Parents are mounted first, so the snapshots of nested filesystems end up on top
+        for point in sorted(mounts, key=len):
+            self.snapshot(mounts[point])
+
+        return self.root, tuple(os.path.realpath(p).lstrip("/") or "." for p in paths)
+
+    def snapshot(self, mount):
+        if (kind := self.kind if self.kind != 'auto' else detect(mount)) not in SNAPSHOTS:
+            raise SnapshotError(f"Unable to snapshot {mount.point}, {mount.fstype} is not supported")
+
+        target = os.path.normpath(join(self.root, mount.point.lstrip("/")))
+        os.makedirs(target, exist_ok=True)
+        if os.path.ismount(target):
+            logger.warning(f"Unmounting the stale snapshot at '{target}'")
+            run(['umount', target])
+
+        logger.info(f"Taking a {kind} snapshot of '{mount.point}'")
+        SNAPSHOTS[kind](self, mount, target)
+
+    def btrfs(self, mount, target):
+        os.makedirs(directory := join(mount.point, ".backup-snapshots"), exist_ok=True)
+        if os.path.exists(snapshot := join(directory, self.name)):
+            run(['btrfs', 'subvolume', 'delete', snapshot])
+
+        self.setup(['btrfs', 'subvolume', 'snapshot', '-r', mount.point, snapshot],
+                   ['btrfs', 'subvolume', 'delete', snapshot])
+        self.setup(['mount', '-o', 'bind,ro', snapshot, target], ['umount', target])
+
+    def zfs(self, mount, target):
+        snapshot = f"{mount.source}@backup-{self.name}"
+        run(['zfs', 'destroy', snapshot], check=False)
+
+        self.setup(['zfs', 'snapshot', snapshot], ['zfs', 'destroy', snapshot])
+        self.setup(['mount', '-o', 'bind,ro', join(mount.point, ".zfs", "snapshot", f"backup-{self.name}"),
+                    target], ['umount', target])
+
+    def lvm(self, mount, target):
+        group, volume = run(['lvs', '--noheadings', '-o', 'vg_name,lv_name', mount.source]).split()
+        snapshot = f"{group}/{volume}-{self.name}-snapshot"
+        run(['lvremove', '--force', snapshot], check=False)
+
+        # Sizes relative to the origin or the free space are given in extents
+        size = ['--extents' if "%" in self.lvm_size else '--size', self.lvm_size]
+        self.setup(['lvcreate', '--snapshot', '--name', snapshot.split("/")[1], *size, f"{group}/{volume}"],
+                   ['lvremove', '--force', snapshot])
+        self.setup(['mount', '-o', LVM_MOUNT_OPTIONS.get(mount.fstype, "ro"), f"/dev/{snapshot}", target],
+                   ['umount', target])
+
+    def setup(self, command, undo):
+        run(command)
+        self.teardown.append(undo)
+
+    def release(self):
+        # Failures are only logged, the remaining snapshots are released regardless
+        while self.teardown:
+            try:
+                run(command := self.teardown.pop())
+            except SnapshotError as e:
+                logger.error(f"Unable to release a snapshot, run '{' '.join(command)}' by hand: {e}")
+
+
+SNAPSHOTS = {'btrfs': SnapshotSet.btrfs, 'zfs': SnapshotSet.zfs, 'lvm': SnapshotSet.lvm}
+
+
+def run(command, check=True) -> str:
+    logger.debug(" ".join(command))
+    proc = sp.run(command, stdout=sp.PIPE, stderr=sp.PIPE, text=True)
+
+    if check and proc.returncode != 0:
+        raise SnapshotError(f"{command[0]} exited with {proc.returncode}: {proc.stderr.strip()}")
+    return proc.stdout
+
+
+def mount_table() -> dict:
+    table = {}
+    with open("/proc/self/mountinfo", 'r') as f:
+        for line in f:
+            fields, _, rest = line.partition(" - ")
+            point, (fstype, source) = fields.split()[4], rest.split()[:2]
+            # Later mounts hide earlier ones on the same mount point
+            table[unescape(point)] = Mount(unescape(point), fstype, unescape(source))
+    return table
+
+
+def find_mount(path, table) -> Mount:
+    while path not in table:
+        path = os.path.dirname(path)
+    return table[path]
+
+
+def detect(mount) -> str:
+    if mount.fstype in ['btrfs', 'zfs']:
+        return mount.fstype
+    if mount.source.startswith(("/dev/mapper/", "/dev/dm-")):
+        return 'lvm'
+    return mount.fstype
+
+
+def unescape(text) -> str:
+    # mountinfo escapes spaces, tabs, newlines and backslashes as octal numbers
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), text)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import re
+import time
+from datetime import datetime as dt
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 60
+UNITS = ['B', 'kB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
+
+SIZE = r"(-?[\d.]+ [kMGTPEZY]?B)"
+FILES_RE = re.compile(r"^Number of files:\s+(\d+)")
+ARCHIVE_RE = re.compile(rf"^This archive:\s+{SIZE}\s+{SIZE}\s+{SIZE}")
+TEXT_PREFIXES = (b"Number of files:", b"This archive:")
+
+
+class BorgStats(object):
+    def __init__(self, command):
+        self.command = command
+        self.start = time.time()
+        self.files = 0
+        self.original_size = 0
+        self.compressed_size = 0
+        self.deduplicated_size = 0
+        self.exit_code = None
+        self.duration = None
+        self.last_report = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return self.duration if self.duration is not None else time.time() - self.start
+
+    @property
+    def throughput(self):
+        return self.original_size / self.elapsed if self.elapsed > 0 else 0.0
+
+    def feed(self, line):
+        # Returns the bytes that should be written to the borg log, or None to drop the line.
+        # Only reformatted json is encoded again, other lines are written as borg printed them.
+        if not line.startswith(b"{"):
+            if line.lstrip().startswith(TEXT_PREFIXES):
+                self.parse_text(line.decode(errors='replace'))
+            return line
+
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return line
+
+        if (kind := message.get('type')) == 'archive_progress':
+            self.parse_progress(message)
+            return None
+        elif kind == 'file_status':
+            return f"{message.get('status')} {message.get('path')}\n".encode(errors='surrogateescape')
+        elif kind == 'log_message':
+            self.parse_text(message.get('message', ""))
+            return "[{}] {:<7} {}\n".format(
+                dt.fromtimestamp(message.get('time', time.time())).strftime("%Y-%m-%d %H:%M:%S"),
+                message.get('levelname', "INFO"), message.get('message', "")).encode(errors='surrogateescape')
+        elif kind in ['progress_message', 'progress_percent']:
+            return None
+        return line
+
+    def parse_progress(self, message):
+        if message.get('finished'):
+            return
+
+        self.files = message.get('nfiles', self.files)
+        self.original_size = message.get('original_size', self.original_size)
+        self.compressed_size = message.get('compressed_size', self.compressed_size)
+        self.deduplicated_size = message.get('deduplicated_size', self.deduplicated_size)
+
+        if time.monotonic() - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = time.monotonic()
+            logger.info(f"Borg {self.command} progress: {self.describe()}")
+
+    def parse_text(self, text):
+        for line in text.splitlines():
+            if (match := FILES_RE.match(line.strip())) is not None:
+                self.files = int(match.group(1))
+            elif (match := ARCHIVE_RE.match(line.strip())) is not None:
+                self.original_size, self.compressed_size, self.deduplicated_size = \
+                    (parse_size(x) for x in match.groups())
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.duration = time.time() - self.start
+        logger.info(f"Borg {self.command} finished: {self.describe()}, exit_code={exit_code}")
+
+    def describe(self):
+        return ", ".join([
+            f"files={self.files}", f"read={format_size(self.original_size)}",
+            f"deduplicated={format_size(self.deduplicated_size)}",
+            f"throughput={format_size(self.throughput)}/s"])
+
+    def totals(self):
+        return {
+            'exit_code': self.exit_code,
+            'files': self.files,
+            'original_size': self.original_size,
+            'compressed_size': self.compressed_size,
+            'deduplicated_size': self.deduplicated_size,
+        }
+
+    def summary(self):
+        return {
+            'command': self.command,
+            'start': dt.fromtimestamp(self.start).isoformat(timespec='seconds'),
+            'duration': round(self.elapsed, 3),
+            'exit_code': self.exit_code,
+            'files': self.files,
+            'original_size': self.original_size,
+            'compressed_size': self.compressed_size,
+            'deduplicated_size': self.deduplicated_size,
+            'throughput': round(self.throughput, 1),
+        }
+
+    def save(self, path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.summary()) + "\n")
+
+
+def parse_size(text):
+    value, unit = text.split()
+    return int(float(value) * 1000 ** UNITS.index(unit))
+
+
+def format_size(size):
+    for unit in UNITS[:-1]:
+        if abs(size) < 1000:
+            return f"{size:.2f} {unit}" if unit != 'B' else f"{size:.0f} B"
+        size /= 1000
+    return f"{size:.2f} {UNITS[-1]}"
@@ -1,25 +1,51 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import contextlib
 import errno
 import logging
 import os
-import pprint as pp
 import shlex
-import subprocess as sp
+import sys
 import textwrap
+import threading
 import time
-import traceback as tb
-from datetime import datetime as dt
 from os.path import dirname, join
 
-from tendo import singleton
-
 import config
+from lazy import lazy_import
+
+futures = lazy_import('concurrent.futures')
+hashlib = lazy_import('hashlib')
+pp = lazy_import('pprint')
+random = lazy_import('random')
+shutil = lazy_import('shutil')
+singleton = lazy_import('tendo.singleton')
+tuning = lazy_import('compression_tuning')
+sp = lazy_import('subprocess')
+tb = lazy_import('traceback')
 
 logger = logging.getLogger(__name__)
 slack = logging.getLogger("slack")
 
+KNOWN_CACHES = [
+    "- sh:**/.cache", "- sh:**/__pycache__", "- sh:**/.mypy_cache", "- sh:**/.pytest_cache",
+    "- sh:**/.gradle/caches", "- sh:**/.npm/_cacache", "- sh:**/.cargo/registry/cache",
+    "- sh:var/cache/apt/archives",
+]
+RESOURCE_KEY_SCRIPT = """
+import os, sys
+path, mount_points = os.path.realpath(sys.argv[1]), map(os.path.realpath, sys.argv[2:])
+if mount_points := [m for m in mount_points if os.path.commonpath([m, path]) == m]:
+    path = max(mount_points, key=len)
+else:
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+print(path)
+"""
+PATTERNS_MAX_AGE = 30 * 86400  # = 30 days, patterns files that weren't used since then are removed
+PATTERN_STYLES = ("fm:", "sh:", "re:", "pp:", "pf:")
+
 
 class CommandGenerator(object):
     # pylint: disable=used-before-assignment
@@ -27,33 +53,66 @@ class CommandGenerator(object):
         self.config = config
         self.arguments = arguments
 
-    def create(self):
+    def create(self, ratelimit=0, archive=None):
         return " ".join(x for x in [
-            "borg", "create", self.create_options(), self.compression(), self.ratelimit(),
-            self.patterns_from(), self.patterns(), self.comment(), self.archive_url(), 
-            self.paths()] if x != "")
+            self.resources(), "borg", "create", self.create_options(), self.compression(), self.ratelimit(ratelimit),
+            self.checkpoint_interval(), self.exclude_if_present(), self.patterns_from(), self.comment(),
+            self.archive_url(archive), self.paths()] if x != "")
 
     def prune(self):
-        return " ".join(x for x in ["borg", "prune", self.prune_options(), self.prefix(),
-                                    self.keep_options()] if x != "")
+        return " ".join(x for x in [self.resources(), "borg", "prune", self.prune_options(),
+                                    self.prefix(), self.keep_options()] if x != "")
+
+    def info(self):
+        return "borg info --json"
+
+    def list_archives(self):
+        return f"borg list --json {self.prefix()}"
+
+    def delete(self, archive):
+        return f"borg delete --info --stats --show-rc '::{archive}'"
+
+    def compact(self):
+        return f"{self.resources()} borg compact --info --show-rc".lstrip()
+
+    def check_repository(self, max_duration):
+        return f"{self.resources()} borg check --info --show-rc --repository-only " \
+               f"--max-duration {max_duration}".lstrip()
+
+    def verify_archive(self, archive):
+        return f"{self.resources()} borg check --info --show-rc --archives-only --verify-data " \
+               f"'::{archive}'".lstrip()
+
+    def resources(self):
+        return " ".join(shlex.join(wrapper) for wrapper in resource_wrappers(self.config))
 
     def create_options(self):
-        return "--info --stats --show-version --show-rc --exclude-caches --list --filter E"
+        return "--info --stats --show-version --show-rc --list --filter E" + \
+            (" --exclude-caches" if self.config.exclude_caches else "") + \
+            (" --log-json --progress" if self.config.borg_progress else "")
 
     def prune_options(self):
-        return "--info --stats --show-version --show-rc --list"
+        return "--info --stats --show-version --show-rc --list" + \
+            (" --log-json" if self.config.borg_progress else "")
 
     def compression(self):
-        return f"--compression '{self.config.archive_compression}'"
+        if (x := self.config.archive_compression) == 'tuned':
+            x = tuning.recommended(self.config.compression_file, "lz4")
+        return f"--compression '{x}'"
 
-    def ratelimit(self):
-        return  "" if (x := self.config.remote_ratelimit) == 0 else f"--remote-ratelimit {x}"
+    def ratelimit(self, rate):
+        return "" if rate == 0 else f"--remote-ratelimit {rate}"
 
-    def patterns_from(self):
-        return "" if (x := self.config.patterns_from) is None else f"--patterns-from '{x}'"
+    def checkpoint_interval(self):
+        return "" if (x := self.config.checkpoint_interval) == 0 else f"--checkpoint-interval {x}"
 
-    def patterns(self):
-        return " ".join(f"--pattern '{p}'" for p in self.config.patterns)
+    def exclude_if_present(self):
+        return " ".join(f"--exclude-if-present '{x}'" for x in self.config.exclude_if_present)
+
+    def patterns_from(self):
+        x = compile_patterns(self.config.patterns_from, self.config.patterns, self.config.exclude_known_caches,
+                             self.config.work_dir is not None)
+        return "" if x is None else f"--patterns-from '{x}'"
 
     def prefix(self):
         return f"--prefix '{self.config.archive_prefix}'"
@@ -68,12 +127,10 @@ class CommandGenerator(object):
         return f"--keep-last {self.config.keep_last}" if self.config.keep_last != 0 else ""
 
     def keep_units(self):
-        return " ".join(f"--keep-{x} {self.config.keep_unit(x)}" for x in [
-                        'secondly', 'minutely', 'hourly', 'daily', 'weekly', 'monthly', 'yearly'
-                        ] if self.config.keep_unit(x) != 0)
+        return " ".join(f"--keep-{unit} {count}" for unit, count in self.config.keep_units)
 
-    def archive_url(self):
-        return "'::" + self.config.archive_prefix + self.config.archive_suffix + "'"
+    def archive_url(self, archive=None):
+        return "'::" + (self.config.archive_name if archive is None else archive) + "'"
 
     def paths(self):
         return "'" + "' '".join(self.config.backup_paths) + "'"
@@ -93,7 +150,7 @@ class EnvironmentGenerator(object):
             "BORG_PASSPHRASE": self.passphrase(),
             "BORG_PASSCOMMAND": self.passphrase_file(),
             "BORG_KEY_FILE": self.key_file(),
-            "BORG_LOGGING_CONF": config.borg_logging_config(),
+            "BORG_LOGGING_CONF": self.logging_config(),
             "BORG_RSH": self.rsh_command(),
             "BORG_RELOCATED_REPO_ACCESS_IS_OK": self.moved_repo_ok(),
             "BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK": self.unknown_repo_ok()
@@ -109,8 +166,15 @@ class EnvironmentGenerator(object):
         port = ":" + str(self.config.ssh_port) if self.config.ssh_port is not None else ""
         return f"{self.config.ssh_user}@{self.config.ssh_host}{port}"
 
+    def logging_config(self):
+        # borg ignores --log-json if a logging config is specified
+        return "" if self.config.borg_progress else config.borg_logging_config()
+
     def rsh_command(self):
-        return "" if (x := self.config.ssh_key_file) is None else f"ssh -i '{x}'"
+        options = ssh_options(identity_file=self.config.ssh_key_file,
+                              control_path=self.config.ssh_control_path,
+                              persist=self.config.ssh_control_persist)
+        return "" if options == "" else f"ssh {options}"
 
     def passphrase(self):
         return "" if (x := self.config.repo_passphrase) is None else x
@@ -138,7 +202,7 @@ def append_tb(text):
     return appendix(text, tb.format_exc())
 
 
-def ensure_single_instance(lock_file: str) -> singleton.SingleInstance:
+def ensure_single_instance(lock_file: str):
     logger.info(f"Checking if there is another instance already running, lock_file='{lock_file}'")
 
     try:
@@ -150,35 +214,197 @@ def ensure_single_instance(lock_file: str) -> singleton.SingleInstance:
     return None
 
 
-def ensure_mounted(mount_point):
+def ensure_mounted(mount_point, timeout=30, mount_command="mount"):
     logger.info(f"Making sure device is mounted, mount_point='{mount_point}'")
-
-    if os.path.ismount(mount_point):
-        logger.debug("A device is already mounted at the mount point, proceeding with backup")
-        return True
+    deadline = time.monotonic() + timeout
 
     try:
-        sp.check_output(shlex.split(f"mount '{mount_point}'"), stderr=sp.STDOUT)
-    except sp.CalledProcessError as e:
-        logger.error(f"An error occurred while mounting the device, exit_code={e.returncode}")
-        logger.debug(appendix("mount produced the following output", e.output.decode().rstrip()))
-        slack.error(f"Failed to mount the device at '{mount_point}'")
+        if is_mounted(mount_point, timeout):
+            logger.debug("A device is already mounted at the mount point, proceeding with backup")
+            return True
+
+        exit_code, output = run_watched(
+            shlex.split(f"{mount_command} '{mount_point}'"), deadline - time.monotonic())
+
+        if exit_code != 0:
+            logger.error(f"An error occurred while mounting the device, exit_code={exit_code}")
+            logger.debug(appendix("mount produced the following output", output.decode().rstrip()))
+            slack.error(f"Failed to mount the device at '{mount_point}'")
+            return False
+
+        if not is_mounted(mount_point, deadline - time.monotonic()):
+            logger.critical(f"The device still doesn't seem to be mounted")
+            slack.critical(f"There seems to be a serious issue with the mount point at {mount_point}")
+            return False
+    except sp.TimeoutExpired:
+        logger.critical(f"The mount point didn't respond within {timeout} seconds, it may be hung")
+        slack.critical(f"The mount point at {mount_point} seems to be hung")
         return False
 
-    if not os.path.ismount(mount_point):
-        logger.critical(f"The device still doesn't seem to be mounted")
-        slack.critical(f"There seems to be a serious issue with the mount point at {mount_point}")
-        return False
+    return True
 
-    return False
-    
 
-def test_connection(user, host, port=None, identity_file=None):
+def mount_chains(mount_points) -> list:
+    # Groups mount points that lie below one another, each group is ordered from the outermost one
+    chains = []
+    for point in sorted(map(os.path.normpath, mount_points), key=len):
+        if (chain := next((c for c in chains if any(is_below(point, p) for p in c)), None)) is None:
+            chains.append(chain := [])
+        chain.append(point)
+    return chains
+
+
+def is_below(path, parent):
+    return os.path.commonpath([path, parent]) == parent
+
+
+def is_mounted(mount_point, timeout):
+    # os.path.ismount blocks indefinitely on a hung mount, so it is run in a separate process
+    command = [sys.executable, "-c", "import os, sys; sys.exit(0 if os.path.ismount(sys.argv[1]) else 1)",
+               mount_point]
+    return run_watched(command, timeout)[0] == 0
+
+
+def run_watched(command, timeout):
+    proc = sp.Popen(command, stdout=sp.PIPE, stderr=sp.STDOUT)
+
+    try:
+        output, _ = proc.communicate(timeout=max(timeout, 0))
+        return proc.returncode, output
+    except sp.TimeoutExpired:
+        # A process stuck in uninterruptible sleep can't be reaped, so it is left behind
+        proc.kill()
+        raise
+
+
+def compile_patterns(patterns_from, patterns, known_caches, relative=False):
+    # Returns a patterns file of patterns-from, the config patterns and known caches, cached by their hash.
+    # Roots are made relative if borg runs in the snapshot directory, so they don't point at the live tree.
+    lines = []
+    if patterns_from is not None:
+        with open(patterns_from, 'r') as f:
+            lines += f.read().splitlines()
+    lines += patterns
+    lines += KNOWN_CACHES if known_caches else []
+
+    if not lines:
+        return None
+
+    digest = hashlib.sha1("\n".join(lines + ["relative"] * relative).encode()).hexdigest()
+    path = join(config.cache_dir(), f"patterns-{digest}")
+    try:
+        # The mtime marks the file as in use, files that weren't used for a while are removed
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.debug(f"Unable to mark the patterns file '{path}' as used: {e}")
+        return path
+
+    patterns = normalize_patterns(lines, relative)
+    logger.debug(f"Compiled {len(lines)} lines into {len(patterns)} patterns, patterns_file='{path}'")
+
+    # Configs with the same patterns may compile them concurrently, each writes its own temporary file
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(config.cache_dir(), mode=0o700, exist_ok=True)
+        with open(temporary, 'w') as f:
+            f.write("\n".join(patterns) + "\n")
+        os.replace(temporary, path)
+    except OSError as e:
+        with contextlib.suppress(OSError):
+            os.remove(temporary)
+        if not os.path.exists(path):
+            logger.error(f"Unable to write the patterns file '{path}': {e}")
+            raise
+
+    remove_stale_patterns(config.cache_dir())
+    return path
+
+
+def remove_stale_patterns(directory):
+    deadline = time.time() - PATTERNS_MAX_AGE
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("patterns-") and entry.stat().st_mtime < deadline:
+                    logger.debug(f"Removing the stale patterns file '{entry.path}'")
+                    os.remove(entry.path)
+    except OSError as e:
+        logger.debug(f"Unable to remove stale patterns files: {e}")
+
+
+def normalize_patterns(lines, relative=False):
+    # The first matching pattern wins, so only roots are moved and only later duplicates are dropped.
+    # Patterns get an explicit style, which makes the P lines that set the default style obsolete.
+    style, roots, patterns, seen = "sh", [], [], set()
+
+    for line in (l.strip() for l in lines):
+        if line == "" or line.startswith("#"):
+            continue
+
+        command, value = line[0], line[1:].lstrip()
+        if command in "Pp":
+            style = value
+            continue
+        elif command in "Rr":
+            entry, target = f"R {value.lstrip('/') or '.' if relative else value}", roots
+        elif command in "+-!":
+            value = value if value.startswith(PATTERN_STYLES) else f"{style}:{value}"
+            entry, target = f"{command} {value}", patterns
+        else:
+            raise ValueError(f"Unknown pattern command '{command}' in '{line}'")
+
+        if entry not in seen:
+            seen.add(entry)
+            target.append(entry)
+
+    return roots + patterns
+
+
+def resource_wrappers(config):
+    # Each wrapper execs the next one, so borg keeps the pid and still receives our signals
+    wrappers = []
+
+    if config.memory_max is not None:
+        if os.path.isdir("/run/systemd/system"):
+            wrappers.append(['systemd-run', '--scope', '--quiet', '--collect',
+                             '-p', f"MemoryMax={config.memory_max}"])
+        else:
+            logger.warning("systemd is not running, borg's memory won't be limited")
+    if config.ionice_class != 'none':
+        priority = [] if config.ionice_class == 'idle' else ['-n', str(config.ionice_priority)]
+        wrappers.append(['ionice', '-c', config.ionice_class, *priority])
+    if config.nice != 0:
+        wrappers.append(['nice', '-n', str(config.nice)])
+    if config.cpu_affinity is not None:
+        wrappers.append(['taskset', '--cpu-list', config.cpu_affinity])
+
+    # borg's environment has no PATH, so the wrappers are resolved here
+    resolved = []
+    for name, *args in wrappers:
+        if (executable := shutil.which(name)) is None:
+            logger.warning(f"Unable to find {name}, borg is started without it")
+        else:
+            resolved.append([executable, *args])
+    return resolved
+
+
+def ssh_options(port=None, identity_file=None, control_path=None, persist=60):
+    return " ".join(x for x in [
+        "" if port is None else f"-p {port}",
+        "" if identity_file is None else f"-i '{identity_file}'",
+        "" if control_path is None else
+        f"-o ControlMaster=auto -o ControlPath='{control_path}' -o ControlPersist={persist}"] if x != "")
+
+
+def test_connection(user, host, port=None, identity_file=None, control_path=None, persist=60):
     logger.info(f"Trying to reach ssh host, host='{host}'")
 
-    command = " ".join(
-        x for x in ["ssh", "-o ConnectTimeout=5", "" if port is None else f"-p {port}", 
-        "" if identity_file is None else f"-i {identity_file}", f"{user}@{host} exit"] if x != "")
+    command = " ".join(x for x in [
+        "ssh", "-o ConnectTimeout=5", ssh_options(port, identity_file, control_path, persist),
+        f"{user}@{host} exit"] if x != "")
 
     try:
         sp.check_output(shlex.split(command), stderr=sp.STDOUT)
@@ -190,6 +416,67 @@ def test_connection(user, host, port=None, identity_file=None):
     return False
 
 
+def close_ssh_master(config):
+    if not config.use_ssh or config.ssh_control_path is None:
+        return
+
+    logger.debug(f"Closing ssh master connection, host='{config.ssh_host}'")
+    command = " ".join(x for x in [
+        "ssh", f"-o ControlPath='{config.ssh_control_path}'", ssh_options(config.ssh_port),
+        f"-O exit {config.ssh_user}@{config.ssh_host}"] if x != "")
+    sp.run(shlex.split(command), stdout=sp.DEVNULL, stderr=sp.DEVNULL)
+
+
+def resource_key(config):
+    # The filesystem is only looked at in a child process, a hung mount below the repository must not
+    # block the other configs. If it doesn't answer, the configured paths are compared instead.
+    if config.use_ssh:
+        return f"ssh://{config.ssh_host}"
+
+    try:
+        exit_code, output = run_watched([sys.executable, "-c", RESOURCE_KEY_SCRIPT, config.repo_path,
+                                         *config.ensure_mounted], config.mount_timeout)
+        if exit_code == 0:
+            return f"file://{output.decode().strip()}"
+    except sp.TimeoutExpired:
+        pass
+
+    logger.warning(f"Unable to find the mount point of the repository, repo_path='{config.repo_path}'")
+    path = os.path.abspath(config.repo_path)
+    mount_points = [m for m in map(os.path.abspath, config.ensure_mounted) if os.path.commonpath([m, path]) == m]
+    return f"file://{max(mount_points, key=len, default=path)}"
+
+
+def run_checks(checks, timeout):
+    # Runs the checks on daemon threads, so checks that hang can't block the exit
+    results = {name: futures.Future() for name in checks}
+
+    for name, check in checks.items():
+        threading.Thread(target=config.with_context(run_check), args=(check, results[name]),
+                         name=f"check-{name}", daemon=True).start()
+
+    futures.wait(results.values(), timeout=timeout)
+    failures = {}
+
+    for name, result in results.items():
+        if not result.done():
+            failures[name] = f"timed out after {timeout} seconds"
+            slack.error(f"Pre-flight check timed out: {name}")
+        elif result.exception() is not None:
+            failures[name] = f"raised {result.exception()!r}"
+        elif not result.result():
+            failures[name] = "failed"
+
+    return failures
+
+
+def run_check(check, result):
+    try:
+        result.set_result(check())
+    except Exception as e:
+        result.set_exception(e)
+
+
 def ask_passphrase(repo_name):
     try:
         return input(f"Passphrase for repository '{repo_name}': ")
@@ -197,10 +484,58 @@ def ask_passphrase(repo_name):
         return ""
 
 
+def current_ratelimit(windows, now=None):
+    # Returns the rate for the time of day and the seconds until it changes, or None if it won't
+    now = now or time.localtime()
+    seconds = now.tm_hour * 3600 + now.tm_min * 60 + now.tm_sec
+
+    def rate_at(second):
+        minute = second % 86400 / 60
+        return next((rate for start, end, rate in windows if (start <= minute < end if start <= end
+                     else not end <= minute < start)), 0)
+
+    boundaries = sorted({(minute * 60 - seconds) % 86400 for start, end, _ in windows
+                         for minute in (start, end)} - {0})
+    rate = rate_at(seconds)
+    return rate, next((delay for delay in boundaries if rate_at(seconds + delay) != rate), None)
+
+
 def trusty_sleep(duration):
-    time_start = time.time()
-    while (waited := time.time() - time_start) < duration:
-        time.sleep(duration - waited)
+    deadline = time.monotonic() + duration
+    while (remaining := deadline - time.monotonic()) > 0:
+        time.sleep(remaining)
+
+
+class RetrySchedule(object):
+    def __init__(self, config):
+        self.config = config
+        self.start = time.monotonic()
+        self.attempts = 0
+
+    def next_delay(self):
+        # Returns the seconds to wait before the next attempt, or None if there is none
+        self.attempts += 1
+
+        if not self.config.do_schedule:
+            logger.debug("Backups aren't rerun, the delay is 0")
+            return None
+
+        if 0 < self.config.backup_max_attempts <= self.attempts:
+            logger.debug(f"Reached the maximum number of attempts, attempts={self.attempts}")
+            return None
+
+        delay = self.config.backup_delay * 60 * self.config.backup_backoff ** (self.attempts - 1)
+        delay *= random.uniform(1 - self.config.backup_jitter, 1 + self.config.backup_jitter)
+        if self.config.backup_max_delay > 0:
+            delay = min(delay, self.config.backup_max_delay * 60)
+
+        if self.config.backup_deadline > 0:
+            if (remaining := self.config.backup_deadline * 60 - (time.monotonic() - self.start)) <= 0:
+                logger.debug(f"Reached the deadline for rerunning the backup, attempts={self.attempts}")
+                return None
+            delay = min(delay, remaining)
+
+        return delay
 
 
 class ConnectionError(Exception):
@@ -215,6 +550,10 @@ class MountPointError(Exception):
     pass
 
 
+class SnapshotError(Exception):
+    pass
+
+
 class BorgCommandError(Exception):
     def __init__(self, *args, exit_code=None):
         super().__init__(*args)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+""" Measures the cold start time of the python scripts in this repository
+
+Every script is started repeatedly with `python -X importtime`. The median
+wall time and import time are appended to a history file and compared with
+the previous entry of the same script, a slowdown beyond the threshold is
+reported as a regression.
+"""
+
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+
+__version__ = "1.0.0"
+
+__scripts_dir__ = Path(__file__).resolve().parent
+
+TARGETS = {
+    "backup.py": ["backups-python/backup.py", "--version"],
+    "setup.py": ["setup/setup.py", "--version"],
+    "note.py": ["note.py", "--version"],
+}
+
+IMPORT_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def parse_importtime(output: str) -> dict:
+    """ Returns the cumulative import time of each top level import in us """
+
+    imports = {}
+    for line in output.splitlines():
+        if (match := IMPORT_RE.match(line)) and match.group(3) == "":
+            imports[match.group(4)] = int(match.group(2))
+    return imports
+
+
+def measure(target: list, runs: int) -> dict:
+    """ Starts the target repeatedly and returns its median start up cost """
+
+    command = [sys.executable, "-X", "importtime", str(__scripts_dir__ / target[0])]
+    wall_times, import_times, imports = [], [], {}
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(command + target[1:], capture_output=True, text=True)
+        wall_times.append(time.perf_counter() - start)
+
+        imports = parse_importtime(proc.stderr)
+        import_times.append(sum(imports.values()) / 1e6)
+
+    slowest = sorted(imports.items(), key=lambda x: x[1], reverse=True)[:5]
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "exit_code": proc.returncode,
+        "wall_time": round(statistics.median(wall_times), 4),
+        "import_time": round(statistics.median(import_times), 4),
+        "slowest_imports": {name: round(us / 1e6, 4) for name, us in slowest},
+    }
+
+
+def load_history(path: Path) -> dict:
+    history = {}
+    if path.exists():
+        with open(path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                history[entry["script"]] = entry
+    return history
+
+
+def main() -> int:
+    parser = ArgumentParser(description=__doc__.splitlines()[0].strip())
+    parser.add_argument("scripts", nargs="*", default=list(TARGETS),
+                        help="scripts to measure (default: all)")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="number of times each script is started")
+    parser.add_argument("-t", "--threshold", type=float, default=20,
+                        help="slowdown in percent that counts as a regression")
+    parser.add_argument("-o", "--output", type=Path, default=Path(
+        os.environ.get("XDG_CACHE_HOME", "~/.cache"), "startup-benchmark.jsonl").expanduser(),
+        help="history file the results are appended to")
+    parser.add_argument("--version", action="version", version="%(prog)s " + __version__)
+    args = parser.parse_args()
+
+    previous = load_history(args.output)
+    regressions = 0
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "a") as f:
+        for script in args.scripts:
+            result = {"script": script, **measure(TARGETS[script], args.runs)}
+            f.write(json.dumps(result) + "\n")
+
+            print("%-10s wall %7.1f ms  imports %7.1f ms  exit %d" % (
+                script, result["wall_time"] * 1e3, result["import_time"] * 1e3,
+                result["exit_code"]))
+            for name, seconds in result["slowest_imports"].items():
+                print("    %-30s %7.1f ms" % (name, seconds * 1e3))
+
+            if (old := previous.get(script)) is not None and \
+                    result["wall_time"] > old["wall_time"] * (1 + args.threshold / 100):
+                regressions += 1
+                print("    REGRESSION: wall time was %.1f ms on %s" % (
+                    old["wall_time"] * 1e3, old["timestamp"]))
+
+    return 1 if regressions > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())